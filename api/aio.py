@@ -0,0 +1,323 @@
+import asyncio
+import json
+import signal
+import sys
+import time
+
+import aio_pika
+import aiohttp
+
+from .base import (API_MAX_ERRORS, API_REFRESH_TIME, ASYNC_CONCURRENCY, ASYNC_PREFETCH, DRAIN_TIMEOUT,
+                   HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, PAGE_RETRIES, POLL_MAX_PAGES, POLL_PAGE_SIZE,
+                   QUEUE_ARGUMENTS, STREAM_MIN_BYTES, logger)
+from .codec import decode, encode, unpack_session
+from .fairness import QueueWait, restamp
+from .itineraries import BestFlights, Columns
+from .maker import Maker
+from .metrics import (API_REQUEST_SECONDS, API_REQUESTS, QUEUE_CONSUMERS, QUEUE_DEPTH, QUEUE_DEPTH_INTERVAL,
+                      SESSION_COMPLETE_SECONDS, SESSION_CREATE_SECONDS, SESSION_POLLS, key_label, serve, span, trace)
+from .poller import Poller
+from .polling import PollingStrategy
+from .ratelimit import KeyScheduler
+from .sharding import MAKE_EXCHANGE, MAKE_QUEUE, POLL_QUEUE, queue_name, shard_weight, sharded
+
+
+class AsyncWorker:
+    queue_name = None
+    exchange = None  # exchange the queue is bound to when sharding
+
+    def __init__(self, config):
+        self.config = config
+        self.queue_name = queue_name(self.queue_name, config)
+        self.prefetch_count = config.get('async-prefetch', ASYNC_PREFETCH)
+        self.concurrency = config.get('async-concurrency', ASYNC_CONCURRENCY)
+        self.keys = KeyScheduler.from_config(config)
+        self.polling = PollingStrategy.from_config(config)
+        self.waits = QueueWait.from_config(self.queue_name, config)
+        self.channel = None
+        self.session = None
+        self.semaphore = None
+        self.in_flight = 0
+
+    @staticmethod
+    async def _read_text(response):
+        return await response.text()
+
+    async def _request(self, method, url, headers, reader=None, **kwargs):
+        key, wait = self.keys.try_acquire()
+        while key is None:
+            await asyncio.sleep(wait)
+            key, wait = self.keys.try_acquire()
+
+        headers = dict(headers, **{'x-rapidapi-key': key})
+        start = time.monotonic()
+        status, response_headers = None, {}
+        try:
+            # Only the HTTP round-trip counts against the concurrency limit, waiting sessions do not
+            async with self.semaphore:
+                async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                    status, response_headers = response.status, response.headers
+                    return status, response_headers, await (reader or self._read_text)(response)
+        finally:
+            self.keys.release(key, status, time.monotonic() - start, response_headers.get('Retry-After'))
+            API_REQUESTS.labels(key_label(key), status or 'error').inc()
+            API_REQUEST_SECONDS.observe(time.monotonic() - start)
+
+    async def _publish(self, message, routing_key, incoming, reply_to=None, priority=None, headers=None):
+        # Encoded like the incoming message it follows, clients that predate codecs only read JSON
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=encode(message, incoming.content_type),
+                correlation_id=incoming.correlation_id,
+                reply_to=reply_to,
+                content_type=incoming.content_type,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                priority=priority,
+                headers=headers
+            ),
+            routing_key=routing_key
+        )
+
+    async def _on_message(self, message):
+        self.in_flight += 1
+        try:
+            async with message.process(requeue=True):
+                self.waits.record(message.headers)
+                await self._handle(message)
+        finally:
+            self.in_flight -= 1
+
+    async def _handle(self, message):
+        raise NotImplementedError
+
+    async def run(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connection = await aio_pika.connect_robust(
+            host=self.config['rabbitmq-host'],
+            login=self.config['rabbitmq-user'],
+            password=self.config['rabbitmq-password']
+        )
+        connector = aiohttp.TCPConnector(limit=self.config.get('http-pool-size', self.concurrency))
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=self.config.get('http-connect-timeout', HTTP_CONNECT_TIMEOUT),
+            sock_read=self.config.get('http-read-timeout', HTTP_READ_TIMEOUT)
+        )
+        async with connection, aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            self.channel = await connection.channel()
+            await self.channel.set_qos(prefetch_count=self.prefetch_count)
+            queue = await self.channel.declare_queue(self.queue_name, durable=True, arguments=QUEUE_ARGUMENTS)
+            if self.exchange and sharded(self.config):
+                exchange = await self.channel.declare_exchange(self.exchange, type='x-consistent-hash', durable=True)
+                await queue.bind(exchange, routing_key=shard_weight(self.config))
+            consumer_tag = await queue.consume(self._on_message)
+            logger.info(f'Consuming {self.queue_name} with prefetch {self.prefetch_count} '
+                        f'and concurrency {self.concurrency}')
+            observer = asyncio.ensure_future(self._observe_queue())
+
+            stop = asyncio.Event()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+            await stop.wait()
+
+            # Messages already being handled are finished, the rest go back to the queue with the connection
+            logger.info(f'Draining {self.in_flight} messages before stopping')
+            await queue.cancel(consumer_tag)
+            deadline = time.monotonic() + self.config.get('drain-timeout', DRAIN_TIMEOUT)
+            while self.in_flight and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+            observer.cancel()
+
+    async def _observe_queue(self):
+        key_queues = [queue_name(MAKE_QUEUE, self.config), queue_name(POLL_QUEUE, self.config)]
+        while True:
+            result = (await self.channel.declare_queue(self.queue_name, passive=True)).declaration_result
+            QUEUE_DEPTH.labels(self.queue_name).set(result.message_count)
+            QUEUE_CONSUMERS.labels(self.queue_name).set(result.consumer_count)
+            # Same split of the key budgets as the blocking workers, see BaseWorker._observe_queue
+            consumers = 0
+            for name in key_queues:
+                queue = await self.channel.declare_queue(name, durable=True, arguments=QUEUE_ARGUMENTS)
+                consumers += queue.declaration_result.consumer_count
+            self.keys.share(1 + consumers)
+            await asyncio.sleep(QUEUE_DEPTH_INTERVAL)
+
+
+class AsyncMaker(AsyncWorker):
+    queue_name = MAKE_QUEUE
+    exchange = MAKE_EXCHANGE
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.poll_queue = queue_name(POLL_QUEUE, config)
+
+    async def _open_session(self, batch, query, message):
+        url, payload, headers = Maker._build_request(query, self.config)
+        start = time.monotonic()
+
+        attempts = 0
+        while True:
+            retry_after = None
+            try:
+                status, response_headers, text = await self._request('POST', url, headers, data=payload)
+                if text == '{}' and 'Location' in response_headers:
+                    break
+                retry_after = response_headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            attempts += 1
+            if attempts > API_MAX_ERRORS:
+                logger.warning("Too many errors received. I'm going to sleep for a while.")
+                await asyncio.sleep(API_REFRESH_TIME)
+                attempts = 0
+            await asyncio.sleep(self.polling.delay(attempts, retry_after))
+
+        SESSION_CREATE_SECONDS.observe(time.monotonic() - start)
+        location = response_headers['Location'].split('/')[-1]
+        await self._publish(
+            Maker._poll_message(batch, query, location),
+            self.poll_queue,
+            message,
+            message.reply_to,
+            message.priority,
+            restamp(message.headers)
+        )
+
+    async def _handle(self, message):
+        # Sessions of a batch are created concurrently, so their publisher confirms are awaited together
+        batch = decode(message.body, message.content_type)
+        queries = list(Maker._expand(batch))
+        with span('create', message.correlation_id):
+            results = await asyncio.gather(*(self._open_session(batch, query, message) for query in queries),
+                                           return_exceptions=True)
+
+        # Requeuing the whole batch would create the sessions that did make it again, only the rest is queued again
+        failed = [(query, result) for query, result in zip(queries, results) if isinstance(result, Exception)]
+        if failed and 'sessions' not in batch:
+            raise failed[0][1]
+        if failed:
+            logger.warning(f'Could not create {len(failed)} of {len(queries)} sessions, queued them again: '
+                           f'{failed[0][1]!r}')
+            await self._publish(
+                dict(batch, sessions=[[query['start_date'], query.get('end_date')] for query, _ in failed]),
+                self.queue_name,
+                message,
+                message.reply_to,
+                message.priority,
+                restamp(message.headers)
+            )
+
+        logger.info(f'Created {len(queries) - len(failed)} sessions')
+
+
+class AsyncPoller(AsyncWorker):
+    queue_name = POLL_QUEUE
+
+    async def _read_columns(self, response):
+        # Same choice between parsing in memory and streaming as Poller._fetch
+        if response.status != 200:
+            return Columns([], [], [], [], [])
+        if 0 < (response.content_length or 0) < self.config.get('stream-min-bytes', STREAM_MIN_BYTES):
+            return Columns.from_body(await response.read())
+        return await Columns.from_async_stream(response.content)
+
+    async def _fetch(self, url, headers, querystring):
+        return await self._request('GET', url, headers, reader=self._read_columns, params=querystring)
+
+    async def _fetch_page(self, data, page_index):
+        # Same retries as Poller._fetch_page
+        url, headers, querystring = Poller._build_request(data, self.config, page_index)
+        for attempt in range(1, self.config.get('page-retries', PAGE_RETRIES) + 1):
+            retry_after = None
+            try:
+                status, response_headers, columns = await self._fetch(url, headers, querystring)
+                if status == 200:
+                    return columns
+                retry_after = response_headers.get('Retry-After')
+            except Exception:
+                pass
+            await asyncio.sleep(self.polling.delay(attempt, retry_after))
+        logger.warning(f'Could not fetch page {page_index} of session {data["location"]}, '
+                       f'the results only cover the pages before it')
+        return None
+
+    async def _walk_pages(self, data, columns):
+        best = BestFlights()
+        best.add(columns)
+        page_size = self.config.get('poll-page-size', POLL_PAGE_SIZE)
+        for page_index in range(1, self.config.get('poll-max-pages', POLL_MAX_PAGES)):
+            if columns.itineraries < page_size or Poller._walk_done(best, self.config):
+                break
+            columns = await self._fetch_page(data, page_index)
+            if columns is None:
+                break
+            best.add(columns)
+        return best
+
+    async def _handle(self, message):
+        data = decode(message.body, message.content_type)
+        query = unpack_session(data)
+        stream = data.get('stream') or query.get('stream')
+        url, headers, querystring = Poller._build_request(data, self.config)
+
+        route = (query['origin'], query['destination'])
+        start = time.monotonic()
+        wait = self.polling.first_delay(route)
+
+        columns = None
+        partial = None
+        attempts = polls = 0
+        while columns is None or columns.status != 'UpdatesComplete':
+            await asyncio.sleep(wait)
+            polls += 1
+            try:
+                status, response_headers, columns = await self._fetch(url, headers, querystring)
+            except Exception:
+                # Bad bodies too, e.g. an error document without Legs, polling goes on like Poller does
+                wait = self.polling.delay(polls)
+                continue
+            wait = self.polling.delay(polls, response_headers.get('Retry-After'))
+            attempts += 1
+            if attempts > API_MAX_ERRORS:
+                logger.warning("Too many errors received. I'm going to sleep for a while.")
+                await asyncio.sleep(API_REFRESH_TIME)
+                attempts = 0
+
+            if stream and columns.status == 'UpdatesPending' and columns.itineraries:
+                best = Poller._get_best_flights(columns)
+                if best != partial:
+                    partial = best
+                    await self._publish(
+                        Poller._reply_message(data, direct=best[0], with_stops=best[1], partial=True),
+                        message.reply_to,
+                        message
+                    )
+
+        elapsed = time.monotonic() - start
+        self.polling.record(route, elapsed)
+        SESSION_POLLS.observe(polls)
+        SESSION_COMPLETE_SECONDS.observe(elapsed)
+        trace('poll', message.correlation_id, elapsed)
+        with span('pages', message.correlation_id):
+            best = await self._walk_pages(data, columns)
+        best_direct, best_with_stops = best.best()
+
+        await self._publish(
+            Poller._reply_message(data, direct=best_direct, with_stops=best_with_stops),
+            message.reply_to,
+            message
+        )
+
+        logger.info(f'Polled session {data["location"]}')
+
+
+WORKERS = {
+    'maker': AsyncMaker,
+    'poller': AsyncPoller
+}
+
+if __name__ == '__main__':
+    with open(sys.argv[2]) as file:
+        config = json.load(file)
+        serve(config)
+        worker = WORKERS[sys.argv[1]](config)
+        asyncio.run(worker.run())
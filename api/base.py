@@ -1,40 +1,194 @@
 import json
 import logging
+import signal
+import threading
+import time
 
 import pika
 import requests
+from requests.adapters import HTTPAdapter
 
+from .metrics import (API_REQUEST_SECONDS, API_REQUESTS, QUEUE_CONSUMERS, QUEUE_DEPTH, QUEUE_DEPTH_INTERVAL,
+                      key_label)
+from .ratelimit import KeyScheduler
+
+API_URL = 'https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com'
 API_WAIT_TIME = 5
 API_MAX_ERRORS = 50
 API_REFRESH_TIME = 1.5 * 60
 
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+
+POLL_INITIAL_WAIT = 1
+POLL_MAX_WAIT = 2 * API_WAIT_TIME
+POLL_BACKOFF = 1.5
+POLL_JITTER = 0.5  # fraction of each wait that is randomized
+POLL_LEARNING_RATE = 0.2
+POLL_PAGE_SIZE = 100
+STREAM_MIN_BYTES = 2 ** 20  # announced bodies smaller than this are parsed in memory, larger or unknown ones streamed
+POLL_MAX_PAGES = 10  # pages walked once a session completes
+PAGE_RETRIES = 3  # attempts at a throttled or failed page before the walk stops there
+POLL_SORT_TYPE = 'price'
+POLL_SORT_ORDER = 'asc'
+POLL_STOPS = 1  # None lists every number of stops
+
+ASYNC_PREFETCH = 200
+ASYNC_CONCURRENCY = 50
+
+MAKE_BATCH_SIZE = 30  # sessions carried by each skyscanner-make message
+INTERACTIVE_BATCH_SIZE = 5  # blocking makers create a batch one session after another, small ones spread the query
+TOP_K = 10
+PRESCREEN_TOP_N = 0  # sessions priced live after browsing cached quotes, 0 prices every date
+PROGRESS_INTERVAL = 3
+
+QUERY_WORKERS = 8  # threads shared by every query for browsing, dispatching and reporting
+MAX_ACTIVE_QUERIES = 20  # queries with sessions in flight, the rest wait for their turn
+MAX_ACTIVE_BULK = 15  # the remaining active slots are kept for interactive queries
+REPLY_PREFETCH = 100
+UNROUTABLE_RETRIES = 5  # times a batch no make queue was bound for is published again before its sessions fail
+UNROUTABLE_DELAY = 2
+
+MAX_PRIORITY = 10
+QUEUE_ARGUMENTS = {'x-max-priority': MAX_PRIORITY}
+INTERACTIVE_PRIORITY = 8
+BULK_PRIORITY = 2
+INTERACTIVE_MAX_SESSIONS = 2 * MAKE_BATCH_SIZE  # larger queries are sweeps that use the leftover capacity
+QUERY_WINDOW = 4 * MAKE_BATCH_SIZE  # sessions a sweep may have in flight at once
+WAIT_REPORT_INTERVAL = 60
+
+SUPERVISOR_INTERVAL = 10
+WORKER_BACKLOG = 20  # messages waiting per worker before its pool grows
+MAKER_MIN_WORKERS = 1
+MAKER_MAX_WORKERS = 8
+POLLER_MIN_WORKERS = 2
+POLLER_MAX_WORKERS = 30
+MAX_CPU_LOAD = 0.9  # load average per core above which pools stop growing
+MAX_THROTTLED_RATIO = 0.05  # share of 429s above which more workers would only burn quota
+SCALE_DOWN_DELAY = 60
+DRAIN_TIMEOUT = 60
+
+SHARD_WEIGHT = 1  # relative share of the routes a shard takes
+
+CACHE_TTL = 30 * 60
+CACHE_SIZE = 10000
+
+PLACES_FILE = 'places.json'
+PLACES_CACHE_SIZE = 1000
+
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
 
+class HttpClient:
+    def __init__(self, pool_size=HTTP_POOL_SIZE, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), transport=None):
+        # Keeps connections alive between requests; any requests adapter can stand in for the network
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        transport = transport or HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', transport)
+        self.session.mount('http://', transport)
+
+    @classmethod
+    def from_config(cls, config, transport=None):
+        return cls(
+            pool_size=config.get('http-pool-size', HTTP_POOL_SIZE),
+            timeout=(config.get('http-connect-timeout', HTTP_CONNECT_TIMEOUT),
+                     config.get('http-read-timeout', HTTP_READ_TIMEOUT)),
+            transport=transport
+        )
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+
+HTTP = HttpClient()
+
+
 class BaseWorker:
-    def __init__(self, config):
+    def __init__(self, config, connection=None):
         self.config = config
 
-        # Setup rabbitmq
-        self.connection = pika.BlockingConnection(pika.ConnectionParameters(
+        # Setup rabbitmq, any connection with the BlockingConnection interface can be given instead
+        self.connection = connection or pika.BlockingConnection(pika.ConnectionParameters(
             host=config['rabbitmq-host'],
             credentials=pika.PlainCredentials(config['rabbitmq-user'], config['rabbitmq-password'])
         ))
         self.channel = self.connection.channel()
         self.channel.basic_qos(prefetch_count=1)
+        self.keys = KeyScheduler.from_config(config)
+        self.http = HttpClient.from_config(config)
+        self.queue = None
+        self.key_queues = ()  # queues whose consumers spend the same API keys as this process
+        self.last_depth = 0
+        self.draining = False
+
+    def _sleep(self, seconds):
+        self.connection.sleep(seconds)
+
+    def _request(self, method, url, headers, **kwargs):
+        key, wait = self.keys.try_acquire()
+        while key is None:
+            self._sleep(wait)
+            key, wait = self.keys.try_acquire()
+
+        headers = dict(headers, **{'x-rapidapi-key': key})
+        start = time.monotonic()
+        try:
+            response = self.http.request(method, url, headers=headers, **kwargs)
+        except Exception:
+            self.keys.release(key, None, time.monotonic() - start)
+            API_REQUESTS.labels(key_label(key), 'error').inc()
+            raise
+        self.keys.release(key, response.status_code, time.monotonic() - start, response.headers.get('Retry-After'))
+        API_REQUESTS.labels(key_label(key), response.status_code).inc()
+        API_REQUEST_SECONDS.observe(time.monotonic() - start)
+        return response
+
+    def _drain(self, signum, frame):
+        # The message being handled is finished and acked, anything prefetched goes back to the queue
+        logger.info('Draining before stopping')
+        self.draining = True
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self._drain)
+        while not self.draining:
+            self.connection.process_data_events(time_limit=1)
+        self.connection.close()
+
+    def _observe_queue(self):
+        # A passive declare every few seconds tells how far behind the consumers of the queue are
+        now = time.monotonic()
+        if self.queue is None or now - self.last_depth < QUEUE_DEPTH_INTERVAL:
+            return
+        self.last_depth = now
+        result = self.channel.queue_declare(queue=self.queue, passive=True)
+        QUEUE_DEPTH.labels(self.queue).set(result.method.message_count)
+        QUEUE_CONSUMERS.labels(self.queue).set(result.method.consumer_count)
+        if self.key_queues:
+            # The supervisor scales the pools, so the budget of the keys is split again among the live workers.
+            # The bot browses with the same keys and counts as one more.
+            self.keys.share(1 + sum(
+                self.channel.queue_declare(queue=queue, durable=True, arguments=QUEUE_ARGUMENTS).method.consumer_count
+                for queue in self.key_queues
+            ))
 
 
-def get_place(api_key, place):
-    url = "https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/autosuggest/v1.0/ES/EUR/es-ES/"
+def get_place(api_key, place, http=HTTP, api_url=API_URL):
+    url = f"{api_url}/apiservices/autosuggest/v1.0/ES/EUR/es-ES/"
     querystring = {"query": place}
     headers = {
         'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com",
         'x-rapidapi-key': api_key
     }
-    response = requests.request("GET", url, headers=headers, params=querystring)
+    response = http.request("GET", url, headers=headers, params=querystring)
+    response.raise_for_status()  # a throttled or failed call says nothing about the place
     response = json.loads(response.text)
     if 'Places' in response and response['Places'] and response['Places'][0]['CityId'] != '-sky':
         return response['Places'][0]['PlaceId']
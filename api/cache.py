@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .base import CACHE_SIZE, CACHE_TTL
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class QuoteCache:
+    def __init__(self, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._quotes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query):
+        return query['origin'], query['destination'], query['start_date'], query.get('end_date', None)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._quotes:
+                return None
+            expires, quote = self._quotes[key]
+            if expires < time.monotonic():
+                del self._quotes[key]
+                return None
+            self._quotes.move_to_end(key)
+            return quote
+
+    def put(self, key, quote):
+        with self._lock:
+            self._quotes[key] = (time.monotonic() + self.ttl, quote)
+            self._quotes.move_to_end(key)
+            while len(self._quotes) > self.size:
+                self._quotes.popitem(last=False)
+
+
+def shared_cache(config):
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = QuoteCache(
+                ttl=config.get('cache-ttl', CACHE_TTL),
+                size=config.get('cache-size', CACHE_SIZE)
+            )
+        return _shared
@@ -0,0 +1,51 @@
+import json
+
+import msgpack
+import orjson
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+CONTENT_TYPES = {
+    'json': JSON,
+    'msgpack': MSGPACK
+}
+
+
+def content_type(config):
+    return CONTENT_TYPES[config.get('codec', 'json')]
+
+
+def encode(obj, content_type=JSON):
+    if content_type == MSGPACK:
+        return msgpack.packb(obj, use_bin_type=True)
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def decode(body, content_type=JSON):
+    # Anything not declared as msgpack is JSON, as every message was before codecs existed
+    if content_type == MSGPACK:
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return json.loads(body)
+
+
+def pack_session(query):
+    # Sessions travel as [origin, destination, outbound, inbound] instead of a query dict
+    return [query['origin'], query['destination'], query['start_date'], query.get('end_date', None)]
+
+
+def unpack_session(message):
+    if 'session' not in message:
+        return message['query']
+    origin, destination, start_date, end_date = message['session']
+    query = {
+        'origin': origin,
+        'destination': destination,
+        'start_date': start_date
+    }
+    if end_date:
+        query['end_date'] = end_date
+    return query
@@ -0,0 +1,220 @@
+import collections
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pika
+
+from .base import (MAX_ACTIVE_BULK, MAX_ACTIVE_QUERIES, QUERY_WORKERS, REPLY_PREFETCH, UNROUTABLE_DELAY,
+                   UNROUTABLE_RETRIES, BaseWorker, logger)
+from .cache import QuoteCache, shared_cache
+from .codec import content_type, decode, encode, unpack_session
+from .fairness import BULK, INTERACTIVE
+from .inflight import REGISTRY
+from .metrics import ACTIVE_QUERIES, REPLY_SECONDS, WAITING_QUERIES
+from .sharding import MAKE_QUEUE, POLL_QUEUE, declare_exchange, sharded
+
+
+def _log_failure(future):
+    # Nobody waits on the futures of callbacks, their errors would be lost otherwise
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('Query callback failed', exc_info=future.exception())
+
+
+class Dispatcher(BaseWorker):
+    # Shares one connection and reply queue among every FlightQuery of the process
+    def __init__(self, config, connection=None, observe=None):
+        super().__init__(config, connection)
+        self.observe = observe  # receives every session priced by the pollers, once, however many queries wait for it
+        self.cache = shared_cache(config)
+        self.content_type = content_type(config)
+        self.max_active = config.get('max-active-queries', MAX_ACTIVE_QUERIES)
+        self.max_active_bulk = min(config.get('max-active-bulk-queries', MAX_ACTIVE_BULK), self.max_active)
+        self.unroutable_retries = config.get('unroutable-retries', UNROUTABLE_RETRIES)
+        self.unroutable_delay = config.get('unroutable-delay', UNROUTABLE_DELAY)
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get('query-workers', QUERY_WORKERS),
+            thread_name_prefix='query'
+        )
+        self.lock = threading.Lock()
+        self.active = {}  # queries with sessions in flight, by correlation id
+        self.active_bulk = set()  # correlation ids of the active queries admitted as sweeps
+        self.waiting = {INTERACTIVE: collections.deque(), BULK: collections.deque()}  # admitted as active ones finish
+
+        # Setup rabbitmq
+        self.channel.basic_qos(prefetch_count=config.get('reply-prefetch', REPLY_PREFETCH))
+        if sharded(config):
+            declare_exchange(self.channel)
+        result = self.channel.queue_declare(queue='', exclusive=True)
+        self.queue = result.method.queue
+        if not sharded(config):
+            # Shards are not known to the bot, each of them has to be given its part of the key budgets instead
+            self.key_queues = (MAKE_QUEUE, POLL_QUEUE)
+        self.channel.basic_consume(
+            queue=self.queue,
+            on_message_callback=self._on_reply
+        )
+        self.channel.add_on_return_callback(self._on_return)
+        self.thread = threading.Thread(target=self.channel.start_consuming, name='dispatcher', daemon=True)
+
+    def _sleep(self, seconds):
+        # Requests are made from the executor, the connection belongs to the consumer thread
+        time.sleep(seconds)
+
+    def request(self, method, url, headers, **kwargs):
+        self.connection.add_callback_threadsafe(self._observe_queue)
+        return self._request(method, url, headers, **kwargs)
+
+    def publish(self, routing_key, body, properties, exchange='', mandatory=False):
+        # pika connections are not thread safe, every publish runs on the consumer thread.
+        # Mandatory messages nobody is bound for come back to _on_return instead of being dropped.
+        self.connection.add_callback_threadsafe(functools.partial(
+            self.channel.basic_publish,
+            exchange=exchange,
+            routing_key=routing_key,
+            properties=properties,
+            body=body,
+            mandatory=mandatory
+        ))
+
+    def call(self, fn, *args, **kwargs):
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def submit(self, query, on_start=None):
+        # Returns the position of the query in the waiting line, 0 when it starts right away.
+        # on_start is only called for queries that had to wait.
+        # Interactive queries wait in a line of their own that goes first, sweeps can never take every slot.
+        query_class = query.expected_class()
+        with self.lock:
+            if not self.waiting[query_class] and self._has_room(query_class):
+                self._admit(query, None, query_class)
+                return 0
+            self.waiting[query_class].append((query, on_start))
+            WAITING_QUERIES.set(sum(map(len, self.waiting.values())))
+            if query_class == INTERACTIVE:
+                return len(self.waiting[INTERACTIVE])
+            return len(self.waiting[INTERACTIVE]) + len(self.waiting[BULK])
+
+    def cancel(self, query):
+        with self.lock:
+            for query_class, waiting in self.waiting.items():
+                self.waiting[query_class] = collections.deque((q, s) for q, s in waiting if q is not query)
+            WAITING_QUERIES.set(sum(map(len, self.waiting.values())))
+        self._release(query)
+
+    def finish(self, query, directs, with_stops):
+        self._release(query)
+        self.call(query.callback, directs, with_stops)
+
+    def _has_room(self, query_class):
+        if len(self.active) >= self.max_active:
+            return False
+        return query_class == INTERACTIVE or len(self.active_bulk) < self.max_active_bulk
+
+    def _admit(self, query, on_start, query_class):
+        self.active[query.uuid] = query
+        if query_class == BULK:
+            self.active_bulk.add(query.uuid)
+        ACTIVE_QUERIES.set(len(self.active))
+        if on_start:
+            self.call(on_start)
+        self.call(self._start, query)
+
+    def _start(self, query):
+        try:
+            query.start()
+        except Exception:
+            logger.exception(f'Query from {query.origin} to {query.destination} failed')
+            # The callback still runs, so whoever asked for the query learns it is over
+            if self._release(query):
+                self.call(query.callback, [], [], failed=True)
+
+    def _release(self, query):
+        # Returns False when the query was no longer active, e.g. cancelled meanwhile
+        with self.lock:
+            if self.active.pop(query.uuid, None) is None:
+                return False
+            self.active_bulk.discard(query.uuid)
+            for query_class in (INTERACTIVE, BULK):
+                waiting = self.waiting[query_class]
+                while waiting and self._has_room(query_class):
+                    self._admit(*waiting.popleft(), query_class)
+            ACTIVE_QUERIES.set(len(self.active))
+            WAITING_QUERIES.set(sum(map(len, self.waiting.values())))
+        return True
+
+    def _deliver(self, correlation_id, result):
+        query = self.active.get(correlation_id)
+        if query is not None:
+            query.on_reply(result)
+
+    @REPLY_SECONDS.time()
+    def _on_reply(self, ch, method, props, body):
+        self._resolve(ch, props, decode(body, props.content_type), body)
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _on_return(self, ch, method, props, body):
+        # No make queue is bound right now, e.g. while the only shard is being replaced
+        returned = (props.headers or {}).get('returned', 0) + 1
+        if returned <= self.unroutable_retries:
+            logger.warning(f'Sessions of query {props.correlation_id} could not be routed to {method.exchange}, '
+                           f'trying again ({returned}/{self.unroutable_retries})')
+            props.headers = dict(props.headers or {}, returned=returned)
+            self.connection.call_later(self.unroutable_delay * returned, functools.partial(
+                ch.basic_publish,
+                exchange=method.exchange,
+                routing_key=method.routing_key,
+                properties=props,
+                body=body,
+                mandatory=True
+            ))
+            return
+
+        # The sessions fail, so the query and the ones waiting on them finish instead of waiting forever
+        batch = decode(body, props.content_type)
+        logger.error(f'Giving up on {len(batch["sessions"])} sessions of query {props.correlation_id}, '
+                     f'nothing is bound to {method.exchange}')
+        for start_date, end_date in batch['sessions']:
+            result = {
+                'direct': None,
+                'with_stops': None,
+                'failed': True,
+                'session': [batch['origin'], batch['destination'], start_date, end_date]
+            }
+            self._resolve(ch, props, result, encode(result, props.content_type))
+
+    def _resolve(self, ch, props, result, body):
+        result['query'] = unpack_session(result)
+        key = QuoteCache.key(result['query'])
+        if result.get('partial'):
+            waiters = REGISTRY.waiting(key)
+        else:
+            with REGISTRY.lock:
+                if not result.get('failed'):
+                    self.cache.put(key, {
+                        'direct': result['direct'],
+                        'with_stops': result['with_stops']
+                    })
+                waiters = REGISTRY.resolve(key)
+            if self.observe and not result.get('failed') and not (props.headers or {}).get('forwarded'):
+                self.observe(result['query'], result['direct'], result['with_stops'])
+
+        # Queries waiting on a session another one created get its results without going through the broker
+        self._deliver(props.correlation_id, result)
+        for correlation_id, reply_to in waiters:
+            if reply_to == self.queue:
+                self._deliver(correlation_id, result)
+            else:
+                ch.basic_publish(
+                    exchange='',
+                    routing_key=reply_to,
+                    properties=pika.BasicProperties(correlation_id=correlation_id, content_type=props.content_type,
+                                                    headers={'forwarded': True}),
+                    body=body
+                )
+
+    def start(self):
+        self.thread.start()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from .base import BULK_PRIORITY, INTERACTIVE_MAX_SESSIONS, INTERACTIVE_PRIORITY, WAIT_REPORT_INTERVAL, logger
+from .metrics import QUEUE_WAIT_SECONDS
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = {
+    INTERACTIVE: INTERACTIVE_PRIORITY,
+    BULK: BULK_PRIORITY
+}
+
+
+def query_class(sessions, config):
+    return INTERACTIVE if sessions <= config.get('interactive-max-sessions', INTERACTIVE_MAX_SESSIONS) else BULK
+
+
+def stamp(query_class):
+    return {'class': query_class, 'published': time.time()}
+
+
+def restamp(headers):
+    # Every hop is stamped again, so each queue measures its own wait
+    return stamp((headers or {}).get('class', BULK))
+
+
+class QueueWait:
+    def __init__(self, queue, interval=WAIT_REPORT_INTERVAL):
+        self.queue = queue
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._waits = {}
+        self._last_report = time.monotonic()
+
+    @classmethod
+    def from_config(cls, queue, config):
+        return cls(queue, config.get('wait-report-interval', WAIT_REPORT_INTERVAL))
+
+    def record(self, headers):
+        if not headers or 'published' not in headers:
+            return
+        wait = max(time.time() - headers['published'], 0)
+        QUEUE_WAIT_SECONDS.labels(self.queue, headers.get('class', BULK)).observe(wait)
+        with self._lock:
+            count, total, longest = self._waits.get(headers.get('class', BULK), (0, 0, 0))
+            self._waits[headers.get('class', BULK)] = (count + 1, total + wait, max(longest, wait))
+            if time.monotonic() - self._last_report >= self.interval:
+                self._report()
+
+    def _report(self):
+        for query_class, (count, total, longest) in sorted(self._waits.items()):
+            logger.info(f'{self.queue} wait for {query_class} queries: {count} messages, '
+                        f'mean {total / count:.2f}s, max {longest:.2f}s')
+        self._waits = {}
+        self._last_report = time.monotonic()
@@ -0,0 +1,36 @@
+import threading
+
+
+class InFlightRegistry:
+    # Sessions published to the makers and not answered yet, with the queries waiting for them besides their creator
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._waiters = {}
+
+    def attach(self, key, correlation_id, reply_to):
+        # Returns True when another query is already making or polling this session
+        with self.lock:
+            if key in self._waiters:
+                self._waiters[key].append((correlation_id, reply_to))
+                return True
+            self._waiters[key] = []
+            return False
+
+    def join(self, key, correlation_id, reply_to):
+        # Like attach, but leaves sessions nobody has published yet to the caller
+        with self.lock:
+            if key in self._waiters:
+                self._waiters[key].append((correlation_id, reply_to))
+                return True
+            return False
+
+    def waiting(self, key):
+        with self.lock:
+            return list(self._waiters.get(key, []))
+
+    def resolve(self, key):
+        with self.lock:
+            return self._waiters.pop(key, [])
+
+
+REGISTRY = InFlightRegistry()
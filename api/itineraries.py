@@ -0,0 +1,224 @@
+import ijson
+import numpy as np
+import orjson
+
+from .topk import TopK
+
+NO_LEG = -1
+
+
+class Columns:
+    # Columnar view of a pricing response: one entry per leg and one per itinerary that is direct or has stops on
+    # every leg. Itineraries mixing both fall in neither category and are dropped before they are priced.
+    def __init__(self, leg_stops, leg_carriers, out_legs, in_legs, prices, status=None, itineraries=None,
+                 carrier_names=None):
+        self.status = status
+        self.itineraries = len(prices) if itineraries is None else itineraries  # listed, usable or not
+        self.leg_stops = np.asarray(leg_stops, dtype=np.int16)
+        self.leg_carriers = leg_carriers  # carrier ids, only the legs of the best itineraries are ever named
+        self.carrier_names = carrier_names or {}
+        self.out_legs = np.asarray(out_legs, dtype=np.int32)
+        self.in_legs = np.asarray(in_legs, dtype=np.int32)
+        self.prices = np.asarray(prices, dtype=np.float64)
+
+    @classmethod
+    def from_response(cls, response):
+        legs, leg_stops, leg_carriers = {}, [], []
+        for leg in response['Legs']:
+            legs[leg['Id']] = len(leg_stops)
+            leg_stops.append(len(leg['Stops']))
+            leg_carriers.append(leg['Carriers'])
+
+        # Every itinerary goes through Python once, so the loop does as little as it can per itinerary
+        direct = [not stops for stops in leg_stops]
+        get = legs.get
+        out_legs, in_legs, prices = [], [], []
+        add_out, add_in, add_price = out_legs.append, in_legs.append, prices.append
+        for itinerary in response['Itineraries']:
+            out_leg = get(itinerary['OutboundLegId'])
+            if out_leg is None:
+                continue
+            in_id = itinerary.get('InboundLegId')
+            if in_id:
+                in_leg = get(in_id)
+                if in_leg is None or direct[out_leg] is not direct[in_leg]:
+                    continue
+            else:
+                in_leg = NO_LEG
+            price = None
+            for p in itinerary['PricingOptions']:
+                if price is None or p['Price'] < price:
+                    price = p['Price']
+            if price is not None:
+                add_out(out_leg)
+                add_in(in_leg)
+                add_price(price)
+
+        return cls(leg_stops, leg_carriers, out_legs, in_legs, prices,
+                   status=response.get('Status'), itineraries=len(response['Itineraries']),
+                   carrier_names={carrier['Id']: carrier['Name'] for carrier in response['Carriers']})
+
+    @classmethod
+    def from_body(cls, body):
+        return cls.from_response(orjson.loads(body))
+
+    @classmethod
+    def from_stream(cls, stream):
+        builder = ColumnBuilder()
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+            builder.feed(prefix, event, value)
+        return builder.build()
+
+    @classmethod
+    async def from_async_stream(cls, stream):
+        builder = ColumnBuilder()
+        async for prefix, event, value in ijson.parse_async(stream, use_float=True):
+            builder.feed(prefix, event, value)
+        return builder.build()
+
+    def airlines(self, i):
+        carriers = self.leg_carriers[self.out_legs[i]]
+        if self.in_legs[i] != NO_LEG:
+            carriers = carriers + self.leg_carriers[self.in_legs[i]]
+        return tuple(dict.fromkeys(self.carrier_names[x] for x in carriers))
+
+    def _top(self, mask, k):
+        candidates = np.flatnonzero(mask)
+        if not len(candidates):
+            return []
+        # Ties keep the itinerary listed first, as the API ranks them
+        if k == 1:
+            order = [np.argmin(self.prices[candidates])]
+        else:
+            order = np.argsort(self.prices[candidates], kind='stable')[:k]
+        return [(float(self.prices[i]), self.airlines(i)) for i in candidates[order]]
+
+    def best_flights(self, k=1):
+        # Both legs direct or both legs with stops, the outbound leg tells which one
+        if not len(self.prices):
+            return [], []
+        direct = self.leg_stops[self.out_legs] == 0
+        return self._top(direct, k), self._top(~direct, k)
+
+
+class ColumnBuilder:
+    # Pulls only the fields the reduction needs out of a stream of ijson events, so a large
+    # response never exists as a whole object tree. Itineraries come before the legs and carriers
+    # they refer to, so ids are resolved once the stream ends.
+    def __init__(self):
+        self.status = None
+        self.itineraries = 0
+        self.out_ids, self.in_ids, self.prices = [], [], []
+        self.leg_ids, self.leg_stops, self.leg_carrier_ids = [], [], []
+        self.carriers = {}
+        self._out_id = self._in_id = self._price = self._carrier_id = None
+        self._handlers = {
+            'Status': self._on_status,
+            'Itineraries.item': self._on_itinerary,
+            'Itineraries.item.OutboundLegId': self._on_out_id,
+            'Itineraries.item.InboundLegId': self._on_in_id,
+            'Itineraries.item.PricingOptions.item.Price': self._on_price,
+            'Legs.item': self._on_leg,
+            'Legs.item.Id': self._on_leg_id,
+            'Legs.item.Stops.item': self._on_leg_stop,
+            'Legs.item.Carriers.item': self._on_leg_carrier,
+            'Carriers.item.Id': self._on_carrier_id,
+            'Carriers.item.Name': self._on_carrier_name
+        }
+
+    def feed(self, prefix, event, value):
+        handler = self._handlers.get(prefix)
+        if handler:
+            handler(event, value)
+
+    def _on_status(self, event, value):
+        self.status = value
+
+    def _on_itinerary(self, event, value):
+        if event == 'start_map':
+            self._out_id = self._in_id = self._price = None
+        elif event == 'end_map':
+            self.itineraries += 1
+            if self._out_id and self._price is not None:
+                self.out_ids.append(self._out_id)
+                self.in_ids.append(self._in_id)
+                self.prices.append(self._price)
+
+    def _on_out_id(self, event, value):
+        self._out_id = value
+
+    def _on_in_id(self, event, value):
+        self._in_id = value
+
+    def _on_price(self, event, value):
+        if self._price is None or value < self._price:
+            self._price = value
+
+    def _on_leg(self, event, value):
+        if event == 'start_map':
+            self.leg_ids.append(None)
+            self.leg_stops.append(0)
+            self.leg_carrier_ids.append([])
+
+    def _on_leg_id(self, event, value):
+        self.leg_ids[-1] = value
+
+    def _on_leg_stop(self, event, value):
+        self.leg_stops[-1] += 1
+
+    def _on_leg_carrier(self, event, value):
+        self.leg_carrier_ids[-1].append(value)
+
+    def _on_carrier_id(self, event, value):
+        self._carrier_id = value
+
+    def _on_carrier_name(self, event, value):
+        self.carriers[self._carrier_id] = value
+
+    def build(self):
+        legs = {leg_id: i for i, leg_id in enumerate(self.leg_ids)}
+
+        # Same selection as Columns.from_response
+        direct = [not stops for stops in self.leg_stops]
+        get = legs.get
+        out_legs, in_legs, prices = [], [], []
+        add_out, add_in, add_price = out_legs.append, in_legs.append, prices.append
+        for out_id, in_id, price in zip(self.out_ids, self.in_ids, self.prices):
+            out_leg = get(out_id)
+            if out_leg is None:
+                continue
+            if in_id:
+                in_leg = get(in_id)
+                if in_leg is None or direct[out_leg] is not direct[in_leg]:
+                    continue
+            else:
+                in_leg = NO_LEG
+            add_out(out_leg)
+            add_in(in_leg)
+            add_price(price)
+
+        return Columns(self.leg_stops, self.leg_carrier_ids, out_legs, in_legs, prices,
+                       status=self.status, itineraries=self.itineraries, carrier_names=self.carriers)
+
+
+class BestFlights:
+    # Running best values over every page of a session, memory stays bounded by k
+    def __init__(self, k=1):
+        self.k = k
+        self.direct = TopK(k)
+        self.with_stops = TopK(k)
+
+    def _push(self, top, flights):
+        for price, airlines in flights:
+            top.push(price, (price, airlines))
+
+    def add(self, columns):
+        if not len(columns.prices):
+            return
+        directs, with_stops = columns.best_flights(self.k)
+        self._push(self.direct, directs)
+        self._push(self.with_stops, with_stops)
+
+    def best(self):
+        direct, with_stops = self.direct.items(), self.with_stops.items()
+        return direct[0] if direct else None, with_stops[0] if with_stops else None
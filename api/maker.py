@@ -1,23 +1,39 @@
 import sys
 
 from .base import *
+from .codec import decode, encode, pack_session
+from .fairness import QueueWait, restamp
+from .metrics import SESSION_CREATE_SECONDS, serve, span
+from .polling import PollingStrategy
+from .sharding import MAKE_QUEUE, POLL_QUEUE, bind_make_queue, queue_name, sharded
 
 
 class Maker(BaseWorker):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, connection=None):
+        super().__init__(config, connection)
+        self.polling = PollingStrategy.from_config(config)
+        self.poll_queue = queue_name(POLL_QUEUE, config)
 
         # Setup rabbitmq
-        result = self.channel.queue_declare(queue='skyscanner-make', auto_delete=True)
+        result = self.channel.queue_declare(
+            queue=queue_name(MAKE_QUEUE, config),
+            durable=True,
+            arguments=QUEUE_ARGUMENTS
+        )
         self.queue = result.method.queue
+        self.waits = QueueWait.from_config(self.queue, config)
+        if sharded(config):
+            bind_make_queue(self.channel, config)
+        self.channel.queue_declare(queue=self.poll_queue, durable=True, arguments=QUEUE_ARGUMENTS)
+        self.key_queues = (self.queue, self.poll_queue)
         self.channel.basic_consume(
             queue=self.queue,
             on_message_callback=self._create_session
         )
 
-    def _create_session(self, ch, method, props, body):
-        url = "https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/pricing/v1.0"
-        query = json.loads(body)
+    @staticmethod
+    def _build_request(query, config):
+        url = f"{config.get('api-url', API_URL)}/apiservices/pricing/v1.0"
         payload = "cabinClass=economy" \
                   "&country=ES" \
                   "&currency=EUR" \
@@ -31,56 +47,94 @@ class Maker(BaseWorker):
 
         headers = {
             'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com",
-            'x-rapidapi-key': query['api_key'],
             'content-type': "application/x-www-form-urlencoded"
         }
+        return url, payload, headers
+
+    @staticmethod
+    def _expand(message):
+        # Batched messages carry a whole date matrix, older ones a single session
+        if 'sessions' not in message:
+            yield message
+            return
+        for start_date, end_date in message['sessions']:
+            query = {
+                'origin': message['origin'],
+                'destination': message['destination'],
+                'start_date': start_date
+            }
+            if end_date:
+                query['end_date'] = end_date
+            if message.get('stream'):
+                query['stream'] = True
+            yield query
+
+    @staticmethod
+    def _poll_message(batch, query, location):
+        if 'sessions' not in batch:
+            # Older clients expect their whole query back
+            return {'location': location, 'query': query}
+        message = {'location': location, 'session': pack_session(query)}
+        if query.get('stream'):
+            message['stream'] = True
+        return message
+
+    def _open_session(self, query):
+        url, payload, headers = self._build_request(query, self.config)
 
         attempts = 0
         while True:
+            retry_after = None
             try:
-                response = requests.request("POST", url, data=payload, headers=headers)
+                response = self._request("POST", url, headers, data=payload)
                 if response.text == '{}' and 'Location' in response.headers:
                     break
-                else:
-                    attempts += 1
-                    if attempts > API_MAX_ERRORS:
-                        logger.warning("Too many errors received. I'm going to sleep for a while.")
-                        self.connection.sleep(API_REFRESH_TIME)
-                        attempts = 0
-            finally:
-                self.connection.sleep(API_WAIT_TIME)
-
-        location = response.headers['Location'].split('/')[-1]
-        self._send_message(
-            json.dumps({
-                'location': location,
-                'query': query
-            }),
-            props.correlation_id,
-            props.reply_to
-        )
+                retry_after = response.headers.get('Retry-After')
+            except requests.RequestException:
+                pass
+            attempts += 1
+            if attempts > API_MAX_ERRORS:
+                logger.warning("Too many errors received. I'm going to sleep for a while.")
+                self.connection.sleep(API_REFRESH_TIME)
+                attempts = 0
+            self.connection.sleep(self.polling.delay(attempts, retry_after))
+
+        return response.headers['Location'].split('/')[-1]
+
+    def _create_session(self, ch, method, props, body):
+        self.waits.record(props.headers)
+        self._observe_queue()
+        batch = decode(body, props.content_type)
+        sessions = 0
+        for query in self._expand(batch):
+            with SESSION_CREATE_SECONDS.time(), span('create', props.correlation_id):
+                location = self._open_session(query)
+            self._send_message(self._poll_message(batch, query, location), props)
+            sessions += 1
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-        logger.info(f'Created session with api-key {query["api_key"]}')
+        logger.info(f'Created {sessions} sessions')
 
-    def _send_message(self, message, correlation_id, reply_to):
+    def _send_message(self, message, props):
+        # Sessions keep the priority and the codec of the query that asked for them
         self.channel.basic_publish(
             exchange='',
-            routing_key='skyscanner-poll',
+            routing_key=self.poll_queue,
             properties=pika.BasicProperties(
-                correlation_id=correlation_id,
-                reply_to=reply_to,
-                content_type='application/json'
+                correlation_id=props.correlation_id,
+                reply_to=props.reply_to,
+                content_type=props.content_type,
+                delivery_mode=2,
+                priority=props.priority,
+                headers=restamp(props.headers)
             ),
-            body=message
+            body=encode(message, props.content_type)
         )
 
-    def run(self):
-        self.channel.start_consuming()
-
 
 if __name__ == '__main__':
     with open(sys.argv[1]) as file:
         config = json.load(file)
+        serve(config)
         maker = Maker(config)
         maker.run()
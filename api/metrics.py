@@ -0,0 +1,71 @@
+import contextlib
+import logging
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+METRICS_PORT_RANGE = 100  # processes sharing a host take the first free port from metrics-port on
+QUEUE_DEPTH_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+API_REQUESTS = Counter('skyscanner_api_requests_total', 'Upstream API requests', ['key', 'status'])
+API_REQUEST_SECONDS = Histogram('skyscanner_api_request_seconds', 'Upstream API request latency')
+SESSION_CREATE_SECONDS = Histogram('skyscanner_session_create_seconds',
+                                   'Time to open a pricing session, retries included',
+                                   buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+SESSION_POLLS = Histogram('skyscanner_session_polls', 'Polls until a session is complete',
+                          buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55))
+SESSION_COMPLETE_SECONDS = Histogram('skyscanner_session_complete_seconds',
+                                     'Time from the first poll to UpdatesComplete',
+                                     buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+QUEUE_DEPTH = Gauge('skyscanner_queue_depth', 'Messages ready in a queue', ['queue'])
+QUEUE_CONSUMERS = Gauge('skyscanner_queue_consumers', 'Consumers of a queue', ['queue'])
+QUEUE_WAIT_SECONDS = Histogram('skyscanner_queue_wait_seconds', 'Time messages waited in a queue before being consumed',
+                               ['queue', 'class'], buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900))
+REPLY_SECONDS = Histogram('skyscanner_reply_seconds', 'Time to fan a reply in to the queries waiting for it')
+QUERY_SECONDS = Histogram('skyscanner_query_seconds', 'End-to-end query latency', ['class'],
+                          buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600))
+ACTIVE_QUERIES = Gauge('skyscanner_active_queries', 'Queries with sessions in flight')
+WAITING_QUERIES = Gauge('skyscanner_waiting_queries', 'Queries waiting for their turn')
+POOL_WORKERS = Gauge('skyscanner_pool_workers', 'Worker processes running in a pool', ['pool'])
+WORKER_RESTARTS = Counter('skyscanner_worker_restarts_total', 'Worker processes that died and were replaced', ['pool'])
+
+_trace = False
+
+
+def serve(config):
+    # Starts the metrics endpoint when metrics-port is set, returns the port taken
+    global _trace
+    _trace = config.get('trace-spans', False)
+    port = config.get('metrics-port')
+    if port is None:
+        return None
+    for candidate in range(port, port + METRICS_PORT_RANGE):
+        try:
+            start_http_server(candidate)
+        except OSError:
+            continue
+        logger.info(f'Serving metrics on port {candidate}')
+        return candidate
+    logger.warning(f'No free port to serve metrics from {port}')
+    return None
+
+
+def key_label(key):
+    return f'{key[:8]}...'
+
+
+def trace(stage, correlation_id, seconds):
+    # Per-stage timings of a query, logged with its correlation id when trace-spans is enabled
+    if _trace:
+        logger.info(f'span stage={stage} correlation_id={correlation_id} seconds={seconds:.3f}')
+
+
+@contextlib.contextmanager
+def span(stage, correlation_id):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        trace(stage, correlation_id, time.monotonic() - start)
@@ -0,0 +1,100 @@
+import difflib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from .base import API_URL, HTTP, PLACES_CACHE_SIZE, PLACES_FILE, get_place, logger
+
+FUZZY_CUTOFF = 0.85
+
+
+def _normalize(name):
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.split())
+
+
+class PlaceIndex:
+    def __init__(self, api_key, path=None, size=PLACES_CACHE_SIZE, http=HTTP, api_url=API_URL):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.path = path
+        self.size = size
+        self.http = http
+        self._places = {}  # PlaceId -> names and aliases, as persisted
+        self._index = {}  # normalized name -> PlaceId
+        self._names = []  # sorted normalized names, for fuzzy lookups
+        self._answers = OrderedDict()  # LRU of past API answers, misses included
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load(path)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['x-rapidapi-keys'][0],
+            path=config.get('places-file', PLACES_FILE),
+            size=config.get('places-cache-size', PLACES_CACHE_SIZE),
+            api_url=config.get('api-url', API_URL)
+        )
+
+    def load(self, path):
+        with open(path) as file:
+            places = json.load(file)
+        with self._lock:
+            for place_id, names in places.items():
+                for name in names:
+                    self._add(place_id, name)
+            self._names = sorted(self._index)
+        logger.info(f'Loaded {len(self._index)} place names from {path}')
+
+    def save(self):
+        with self._lock:
+            places = {place_id: list(names) for place_id, names in self._places.items()}
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(places, file, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def _add(self, place_id, name):
+        self._places.setdefault(place_id, []).append(name)
+        self._index[_normalize(name)] = place_id
+
+    def _find(self, name):
+        # No prefixes, the index only knows the places seen so far, so "Santa" would be taken for Santander
+        if name in self._index:
+            return self._index[name]
+
+        close = difflib.get_close_matches(name, self._names, n=1, cutoff=FUZZY_CUTOFF)
+        if close:
+            return self._index[close[0]]
+        return None
+
+    def lookup(self, place):
+        name = _normalize(place)
+        with self._lock:
+            place_id = self._find(name)
+            if place_id:
+                return place_id
+            if name in self._answers:
+                self._answers.move_to_end(name)
+                return self._answers[name]
+
+        try:
+            place_id = get_place(self.api_key, place, http=self.http, api_url=self.api_url)
+        except Exception as e:
+            # Not remembered, the place may well exist
+            logger.warning(f'Could not look up {place}: {e}')
+            return None
+        with self._lock:
+            self._answers[name] = place_id
+            while len(self._answers) > self.size:
+                self._answers.popitem(last=False)
+            if place_id:
+                self._add(place_id, place.strip())
+                self._names = sorted(self._index)
+        if place_id and self.path:
+            self.save()
+        return place_id
@@ -0,0 +1,55 @@
+import collections
+
+
+def _order(candidate):
+    # Cheapest known price first, sessions without one are priced last
+    bound = candidate[0]
+    return bound is None, bound or 0
+
+
+class Planner:
+    # Hands out the sessions of a query cheapest first, in batches of a single route as the makers expect
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.pruned = 0
+        self._routes = {}  # sessions still to be sent of every route, as (lower bound, session) cheapest first
+
+    def __bool__(self):
+        return bool(self._routes)
+
+    def __len__(self):
+        return sum(len(sessions) for sessions in self._routes.values())
+
+    def extend(self, candidates):
+        # candidates are (lower bound, route, session), the bound is None when no price is known
+        routes = collections.defaultdict(list)
+        for bound, route, session in candidates:
+            routes[route].append((bound, session))
+        for route, sessions in routes.items():
+            sessions.extend(self._routes.get(route, ()))
+            self._routes[route] = collections.deque(sorted(sessions, key=_order))
+
+    def next_batch(self):
+        route = min(self._routes, key=lambda r: _order(self._routes[r][0]))
+        sessions = self._routes[route]
+        batch = [sessions.popleft()[1] for _ in range(min(self.batch_size, len(sessions)))]
+        if not sessions:
+            del self._routes[route]
+        return route, batch
+
+    def prune(self, threshold, drop):
+        # Sessions that can not get under the threshold are skipped, drop is told about each of them
+        if threshold is None:
+            return
+        for route in list(self._routes):
+            kept = collections.deque()
+            for bound, session in self._routes[route]:
+                if bound is None or bound < threshold:
+                    kept.append((bound, session))
+                else:
+                    drop(route, session)
+            self.pruned += len(self._routes[route]) - len(kept)
+            if kept:
+                self._routes[route] = kept
+            else:
+                del self._routes[route]
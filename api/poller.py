@@ -1,120 +1,189 @@
 import sys
 
 from .base import *
+from .codec import decode, encode, unpack_session
+from .fairness import QueueWait
+from .metrics import SESSION_COMPLETE_SECONDS, SESSION_POLLS, serve, span, trace
+from .itineraries import BestFlights, Columns
+from .polling import PollingStrategy
+from .sharding import MAKE_QUEUE, POLL_QUEUE, queue_name
 
 
 class Poller(BaseWorker):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, connection=None):
+        super().__init__(config, connection)
+        self.polling = PollingStrategy.from_config(config)
 
         # Setup rabbitmq
-        result = self.channel.queue_declare(queue='skyscanner-poll', auto_delete=True)
+        result = self.channel.queue_declare(
+            queue=queue_name(POLL_QUEUE, config),
+            durable=True,
+            arguments=QUEUE_ARGUMENTS
+        )
         self.queue = result.method.queue
+        self.waits = QueueWait.from_config(self.queue, config)
+        self.key_queues = (queue_name(MAKE_QUEUE, config), self.queue)
         self.channel.basic_consume(
             queue=self.queue,
             on_message_callback=self._poll_session
         )
 
     @staticmethod
-    def _get_best_flight(itineraries, flights):
-        best = None
-
-        for itinerary in itineraries:
-            out_id = itinerary['OutboundLegId']
-            if 'InboundLegId' in itinerary:
-                in_id = itinerary['InboundLegId']
-            else:
-                in_id = None
+    def _get_best_flights(columns):
+        directs, with_stops = columns.best_flights()
+        return directs[0] if directs else None, with_stops[0] if with_stops else None
 
-            if out_id not in flights or (in_id and in_id not in flights):
-                continue
-
-            for p in itinerary['PricingOptions']:
-                if not best or p['Price'] < best[0]:
-                    airlines = set(flights[out_id])
-                    if in_id:
-                        airlines.update(set(flights[in_id]))
-                    best = (
-                        p['Price'],
-                        tuple(airlines)
-                    )
+    @staticmethod
+    def _reply_message(data, **fields):
+        # Replies name their session the way it was asked for
+        if 'session' in data:
+            fields['session'] = data['session']
+        else:
+            fields['query'] = data['query']
+        return fields
+
+    def _fetch(self, url, headers, querystring):
+        # Pages are small and parse much faster in memory. Large bodies are parsed while they download, keeping only
+        # the fields the reduction needs.
+        with self._request("GET", url, headers, params=querystring, stream=True) as response:
+            if not response.ok:
+                return response, Columns([], [], [], [], [])
+            length = int(response.headers.get('Content-Length') or 0)
+            if 0 < length < self.config.get('stream-min-bytes', STREAM_MIN_BYTES):
+                return response, Columns.from_body(response.content)
+            response.raw.decode_content = True
+            return response, Columns.from_stream(response.raw)
 
-        return best
+    @staticmethod
+    def _walk_done(best, config):
+        # Pages come cheapest first, once every category has its best flight the next ones can not improve them
+        sort = config.get('poll-sort-type', POLL_SORT_TYPE), config.get('poll-sort-order', POLL_SORT_ORDER)
+        if sort != ('price', 'asc'):
+            return False
+        if best.direct.threshold is None:
+            return False
+        return config.get('poll-stops', POLL_STOPS) == 0 or best.with_stops.threshold is not None
 
-    def _poll_session(self, ch, method, props, body):
-        data = json.loads(body)
-        url = f"https://skyscanner-skyscanner-flight-search-v1.p.rapidapi.com/apiservices/pricing/uk2/v1.0/{data['location']}"
+    @staticmethod
+    def _build_request(data, config, page_index=0):
+        url = f"{config.get('api-url', API_URL)}/apiservices/pricing/uk2/v1.0/{data['location']}"
         headers = {
-            'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com",
-            'x-rapidapi-key': data['query']['api_key']
+            'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com"
         }
+        querystring = {
+            "pageIndex": str(page_index),
+            "pageSize": str(config.get('poll-page-size', POLL_PAGE_SIZE)),
+            "sortType": config.get('poll-sort-type', POLL_SORT_TYPE),
+            "sortOrder": config.get('poll-sort-order', POLL_SORT_ORDER)
+        }
+        stops = config.get('poll-stops', POLL_STOPS)
+        if stops is not None:
+            querystring["stops"] = str(stops)
+        return url, headers, querystring
+
+    def _fetch_page(self, data, page_index):
+        # An empty page would look like the last one, so failed pages are retried and then reported
+        url, headers, querystring = self._build_request(data, self.config, page_index)
+        for attempt in range(1, self.config.get('page-retries', PAGE_RETRIES) + 1):
+            retry_after = None
+            try:
+                response, columns = self._fetch(url, headers, querystring)
+                if response.ok:
+                    return columns
+                retry_after = response.headers.get('Retry-After')
+            except Exception:
+                pass
+            self.connection.sleep(self.polling.delay(attempt, retry_after))
+        logger.warning(f'Could not fetch page {page_index} of session {data["location"]}, '
+                       f'the results only cover the pages before it')
+        return None
+
+    def _walk_pages(self, data, columns):
+        # Price-sorted pages of a completed session, reduced one at a time
+        best = BestFlights()
+        best.add(columns)
+        page_size = self.config.get('poll-page-size', POLL_PAGE_SIZE)
+        for page_index in range(1, self.config.get('poll-max-pages', POLL_MAX_PAGES)):
+            if columns.itineraries < page_size or self._walk_done(best, self.config):
+                break
+            columns = self._fetch_page(data, page_index)
+            if columns is None:
+                break
+            best.add(columns)
+        return best
 
-        querystring = {"pageIndex": "0", "pageSize": "100", "stops": "1", "sortType": "duration"}
-
-        response = {}
-        attempts = 0
-        while 'Status' not in response or response['Status'] != 'UpdatesComplete':
-            self.connection.sleep(API_WAIT_TIME)
+    def _poll_session(self, ch, method, props, body):
+        self.waits.record(props.headers)
+        self._observe_queue()
+        data = decode(body, props.content_type)
+        query = unpack_session(data)
+        stream = data.get('stream') or query.get('stream')
+        url, headers, querystring = self._build_request(data, self.config)
+
+        route = (query['origin'], query['destination'])
+        start = time.monotonic()
+        wait = self.polling.first_delay(route)
+
+        columns = None
+        partial = None
+        attempts = polls = 0
+        while columns is None or columns.status != 'UpdatesComplete':
+            self.connection.sleep(wait)
+            polls += 1
             try:
-                response = requests.request("GET", url, headers=headers, params=querystring)
+                response, columns = self._fetch(url, headers, querystring)
             except Exception:
+                wait = self.polling.delay(polls)
                 continue
-            response = json.loads(response.text)
+            wait = self.polling.delay(polls, response.headers.get('Retry-After'))
             attempts += 1
             if attempts > API_MAX_ERRORS:
                 logger.warning("Too many errors received. I'm going to sleep for a while.")
                 self.connection.sleep(API_REFRESH_TIME)
                 attempts = 0
 
-        itineraries = response['Itineraries']
-        legs = response['Legs']
-        carriers = response['Carriers']
-
-        airlines = {}
-        for carrier in carriers:
-            airlines[carrier['Id']] = carrier['Name']
-
-        direct_flights, stops_flights = {}, {}
-        for leg in legs:
-            flights = tuple(airlines[x] for x in leg['Carriers'])
-            if not leg['Stops']:
-                direct_flights[leg['Id']] = flights
-            else:
-                stops_flights[leg['Id']] = flights
+            if stream and columns.status == 'UpdatesPending' and columns.itineraries:
+                best = self._get_best_flights(columns)
+                if best != partial:
+                    partial = best
+                    self._send_message(
+                        self._reply_message(data, direct=best[0], with_stops=best[1], partial=True),
+                        props
+                    )
 
-        best_direct = self._get_best_flight(itineraries, direct_flights)
-        best_with_stops = self._get_best_flight(itineraries, stops_flights)
+        elapsed = time.monotonic() - start
+        self.polling.record(route, elapsed)
+        SESSION_POLLS.observe(polls)
+        SESSION_COMPLETE_SECONDS.observe(elapsed)
+        trace('poll', props.correlation_id, elapsed)
+        with span('pages', props.correlation_id):
+            best = self._walk_pages(data, columns)
+        best_direct, best_with_stops = best.best()
 
         self._send_message(
-            json.dumps({
-                'direct': best_direct,
-                'with_stops': best_with_stops,
-                'query': data['query']
-            }),
-            props.correlation_id,
-            props.reply_to
+            self._reply_message(data, direct=best_direct, with_stops=best_with_stops),
+            props
         )
         ch.basic_ack(delivery_tag=method.delivery_tag)
 
-        logger.info(f'Polled session with api-key {data["query"]["api_key"]}')
+        logger.info(f'Polled session {data["location"]}')
 
-    def _send_message(self, message, correlation_id, destination):
+    def _send_message(self, message, props):
+        # Replies are encoded like the message they answer, clients that predate codecs only read JSON
         self.channel.basic_publish(
             exchange='',
-            routing_key=destination,
+            routing_key=props.reply_to,
             properties=pika.BasicProperties(
-                correlation_id=correlation_id,
-                content_type='application/json'
+                correlation_id=props.correlation_id,
+                content_type=props.content_type
             ),
-            body=message
+            body=encode(message, props.content_type)
         )
 
-    def run(self):
-        self.channel.start_consuming()
-
 
 if __name__ == '__main__':
     with open(sys.argv[1]) as file:
         config = json.load(file)
+        serve(config)
         poller = Poller(config)
         poller.run()
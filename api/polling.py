@@ -0,0 +1,44 @@
+import random
+import threading
+
+from .base import POLL_BACKOFF, POLL_INITIAL_WAIT, POLL_JITTER, POLL_LEARNING_RATE, POLL_MAX_WAIT
+
+
+class PollingStrategy:
+    def __init__(self, initial=POLL_INITIAL_WAIT, max_wait=POLL_MAX_WAIT, factor=POLL_BACKOFF, jitter=POLL_JITTER):
+        self.initial = initial
+        self.max_wait = max_wait
+        self.factor = factor
+        self.jitter = jitter
+        self._completion_times = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            initial=config.get('poll-initial-wait', POLL_INITIAL_WAIT),
+            max_wait=config.get('poll-max-wait', POLL_MAX_WAIT),
+            factor=config.get('poll-backoff', POLL_BACKOFF),
+            jitter=config.get('poll-jitter', POLL_JITTER)
+        )
+
+    def delay(self, attempt, retry_after=None):
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            pass
+        wait = min(self.max_wait, self.initial * self.factor ** attempt)
+        return wait * (1 - self.jitter * random.random())
+
+    def first_delay(self, route):
+        # Sessions for a route usually take about as long as they took last times
+        with self._lock:
+            learned = self._completion_times.get(route)
+        if learned is None:
+            return self.delay(0)
+        return min(learned, self.max_wait)
+
+    def record(self, route, elapsed):
+        with self._lock:
+            learned = self._completion_times.get(route, elapsed)
+            self._completion_times[route] = learned + POLL_LEARNING_RATE * (elapsed - learned)
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+KEY_RATE = 1  # requests per second allowed to each key by the whole deployment, shared among its processes
+KEY_BURST = 5
+KEY_COOLDOWN = 1.5 * 60  # rest given to a throttled key when the API does not send Retry-After
+LATENCY_SMOOTHING = 0.2
+
+logger = logging.getLogger(__name__)
+
+
+class KeyState:
+    __slots__ = ('tokens', 'updated', 'cooldown_until', 'in_flight', 'latency', 'throttled')
+
+    def __init__(self, burst):
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.cooldown_until = 0
+        self.in_flight = 0
+        self.latency = 0
+        self.throttled = 0
+
+
+class KeyScheduler:
+    def __init__(self, api_keys, rate=KEY_RATE, burst=KEY_BURST):
+        self.key_rate = rate
+        self.key_burst = burst
+        self.rate = rate
+        self.burst = burst
+        self._keys = {key: KeyState(burst) for key in api_keys}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            config['x-rapidapi-keys'],
+            rate=config.get('api-key-rate', KEY_RATE),
+            burst=config.get('api-key-burst', KEY_BURST)
+        )
+
+    def share(self, clients):
+        # Every process keeps its own buckets, so each one only spends its part of the budget of a key
+        with self._lock:
+            self.rate = self.key_rate / max(clients, 1)
+            self.burst = max(self.key_burst / max(clients, 1), 1)
+
+    def _refill(self, state, now):
+        state.tokens = min(self.burst, state.tokens + (now - state.updated) * self.rate)
+        state.updated = now
+
+    def try_acquire(self):
+        # Returns the least loaded healthy key with budget left, or the time to wait for one
+        now = time.monotonic()
+        with self._lock:
+            best, wait = None, None
+            for key, state in self._keys.items():
+                self._refill(state, now)
+                ready_at = max(state.cooldown_until, now + (1 - state.tokens) / self.rate)
+                if ready_at > now:
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                    continue
+                score = (state.in_flight, -state.tokens, state.latency)
+                if best is None or score < best[0]:
+                    best = (score, key, state)
+
+            if best is None:
+                return None, wait
+            _, key, state = best
+            state.tokens -= 1
+            state.in_flight += 1
+            return key, 0
+
+    def release(self, key, status, latency, retry_after=None):
+        with self._lock:
+            state = self._keys[key]
+            state.in_flight -= 1
+            state.latency += LATENCY_SMOOTHING * (latency - state.latency)
+            if status == 429:
+                try:
+                    cooldown = float(retry_after)
+                except (TypeError, ValueError):
+                    cooldown = KEY_COOLDOWN
+                state.cooldown_until = time.monotonic() + cooldown
+                state.tokens = 0
+                state.throttled += 1
+                logger.warning(f'API key {key[:8]}... throttled, resting it for {cooldown:.0f}s')
@@ -0,0 +1,43 @@
+import socket
+
+from .base import SHARD_WEIGHT
+
+MAKE_QUEUE = 'skyscanner-make'
+POLL_QUEUE = 'skyscanner-poll'
+MAKE_EXCHANGE = 'skyscanner-make-shards'  # x-consistent-hash, needs the rabbitmq_consistent_hash_exchange plugin
+
+
+def sharded(config):
+    return config.get('sharding', False)
+
+
+def shard_name(config):
+    return config.get('shard') or socket.gethostname()
+
+
+def queue_name(queue, config):
+    # Each shard consumes its own make and poll queues, so the sessions of a route stay on one shard
+    return f'{queue}.{shard_name(config)}' if sharded(config) else queue
+
+
+def shard_weight(config):
+    # Consistent-hash bindings take the weight of the queue as their routing key
+    return str(config.get('shard-weight', SHARD_WEIGHT))
+
+
+def route_key(origin, destination):
+    return f'{origin}-{destination}'
+
+
+def declare_exchange(channel):
+    channel.exchange_declare(exchange=MAKE_EXCHANGE, exchange_type='x-consistent-hash', durable=True)
+
+
+def bind_make_queue(channel, config):
+    declare_exchange(channel)
+    channel.queue_bind(queue=queue_name(MAKE_QUEUE, config), exchange=MAKE_EXCHANGE, routing_key=shard_weight(config))
+
+
+def unbind_make_queue(channel, config):
+    # New sessions of the routes of this shard hash to the remaining ones from now on
+    channel.queue_unbind(queue=queue_name(MAKE_QUEUE, config), exchange=MAKE_EXCHANGE, routing_key=shard_weight(config))
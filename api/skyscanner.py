@@ -1,26 +1,67 @@
 import datetime
 import json
+import threading
+import time
 import uuid
 
 import pika
 
-from .base import BaseWorker, logger
+from .base import (API_URL, INTERACTIVE_BATCH_SIZE, MAKE_BATCH_SIZE, PRESCREEN_TOP_N, PROGRESS_INTERVAL, QUERY_WINDOW,
+                   TOP_K, logger)
+from .cache import QuoteCache
+from .codec import encode
+from .fairness import BULK, INTERACTIVE, PRIORITIES, query_class, stamp
+from .inflight import REGISTRY
+from .metrics import QUERY_SECONDS, span, trace
+from .planner import Planner
+from .sharding import MAKE_EXCHANGE, MAKE_QUEUE, route_key, sharded
+from .topk import TopK
 
 
-class FlightQuery(BaseWorker):
-    def __init__(self, config, query, callback):
-        super().__init__(config)
+def _places(places):
+    # A single PlaceId or several of them, e.g. the airports around a city
+    return list(dict.fromkeys([places] if isinstance(places, str) else places))
+
+
+class FlightQuery:
+    def __init__(self, dispatcher, query, callback, progress=None, completed=None, checkpoint=None, history=None):
+        config = dispatcher.config
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()  # replies are handled by the dispatcher while the query may still be starting
 
         self.uuid = str(uuid.uuid4())
-        self.api_keys = config['x-rapidapi-keys']
         self.callback = callback
+        self.progress = progress  # receives the best results so far while sessions are still pending
+        self.completed = completed or {}  # results of the sessions finished before a restart, by cache key
+        self.checkpoint = checkpoint  # receives every finished session so it can be persisted
+        self.history = history  # returns the cheapest prices observed for the route, by (start_date, end_date)
+        self.progress_interval = config.get('progress-interval', PROGRESS_INTERVAL)
+        self.last_progress = 0
+        self.cache = dispatcher.cache
+        self.content_type = dispatcher.content_type
 
-        self.pending_sessions = 0  # stores the number of sessions pending from response
-        self.results = []
+        self.pending = set()  # stores the sessions pending from response
+        self.total_sessions = 0
+        self.batch_size = config.get('make-batch-size', MAKE_BATCH_SIZE)
+        self.interactive_batch_size = config.get('interactive-batch-size', INTERACTIVE_BATCH_SIZE)
+        self.prescreen_top_n = config.get('prescreen-top-n', PRESCREEN_TOP_N)
+        self.top_k = config.get('top-k', TOP_K)
+        self.directs = TopK(self.top_k)
+        self.with_stops = TopK(self.top_k)
+        self.partials = {}  # latest intermediate result of each session still being polled
+        self.window = config.get('query-window', QUERY_WINDOW)
+        self.api_url = config.get('api-url', API_URL)
+        self.query_class = None
+        self.planner = Planner(self.batch_size)  # sessions of a sweep waiting for room in its window
+        self.in_flight = set()  # sessions sent to the makers and not answered yet
+        self.created_at = time.monotonic()  # latency counts the wait for admission too
 
         # Common data to round and one-way trips
-        self.origin = query['origin']
-        self.destination = query['destination']
+        self.origins = _places(query['origin'])
+        self.destinations = _places(query['destination'])
+        self.origin = ','.join(self.origins)
+        self.destination = ','.join(self.destinations)
+        self.routes = [(o, d) for o in self.origins for d in self.destinations if o != d]
         self.start_date = query['start_date']
         self.end_date = query['end_date']
 
@@ -28,94 +69,272 @@ class FlightQuery(BaseWorker):
         self.min_days = query.get('min_days', None)
         self.max_days = query.get('max_days', None)
 
-        # Setup rabbitmq
-        result = self.channel.queue_declare(queue='', exclusive=True)
-        self.queue = result.method.queue
-        self.channel.basic_consume(
-            queue=self.queue,
-            on_message_callback=self._result_callback
-        )
-
-    def _send_message(self, obj):
-        self.channel.basic_publish(
-            exchange='',
-            routing_key='skyscanner-make',
-            properties=pika.BasicProperties(
+    def _send_message(self, route, obj):
+        # Sharded deployments hash the route to pick the shard, so its sessions always land on the same workers
+        if sharded(self.dispatcher.config):
+            exchange, routing_key = MAKE_EXCHANGE, route_key(*route)
+        else:
+            exchange, routing_key = '', MAKE_QUEUE
+        self.dispatcher.publish(
+            routing_key,
+            encode(obj, self.content_type),
+            pika.BasicProperties(
                 correlation_id=self.uuid,
-                reply_to=self.queue,
-                content_type='application/json'
+                reply_to=self.dispatcher.queue,
+                content_type=self.content_type,
+                delivery_mode=2,
+                priority=PRIORITIES[self.query_class],
+                headers=stamp(self.query_class)
             ),
-            body=json.dumps(obj)
+            exchange,
+            mandatory=True
         )
 
-    def _result_callback(self, ch, method, props, body):
-        if self.uuid == props.correlation_id:
-            self.results.append(json.loads(body))
-            self.pending_sessions -= 1
-
-        directs, with_stops = [], []
-        if self.pending_sessions == 0:
-            for r in self.results:
-                query = r['query']
-                if r['direct']:
-                    price, airlines = r['direct']
-                    directs.append(Result(
-                        price=price,
-                        airlines=airlines,
-                        origin=query['origin'],
-                        destination=query['destination'],
-                        start_date=query['start_date'],
-                        end_date=query.get('end_date', None)
-                    ))
-                if r['with_stops']:
-                    price, airlines = r['with_stops']
-                    with_stops.append(Result(
-                        price=price,
-                        airlines=airlines,
-                        origin=query['origin'],
-                        destination=query['destination'],
-                        start_date=query['start_date'],
-                        end_date=query.get('end_date', None)
-                    ))
-
-            directs.sort()
-            with_stops.sort()
-            self.callback(directs, with_stops)
-
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-        if self.pending_sessions == 0:
-            self.connection.close()
-
-    def execute(self):
-        current = self.start_date
+    def _send_backlog(self):
+        # Sweeps only refill their window as sessions come back, so they take turns with each other
+        self.planner.prune(self._threshold(), self._drop)
+        while self.planner and (self.query_class == INTERACTIVE or len(self.in_flight) < self.window):
+            route, sessions = self.planner.next_batch()
+            sessions = [session for session in sessions if self._claim(self._session(route, *session))]
+            if not sessions:
+                continue
+            self.in_flight.update(QuoteCache.key(self._session(route, *session)) for session in sessions)
+            batch = {
+                'origin': route[0],
+                'destination': route[1],
+                'sessions': sessions
+            }
+            if self.progress:
+                batch['stream'] = True
+            self._send_message(route, batch)
+
+    def _threshold(self):
+        # Price a session has to beat to change the results, None while they still have room
+        thresholds = (self.directs.threshold, self.with_stops.threshold)
+        return None if None in thresholds else max(thresholds)
+
+    def _drop(self, route, session):
+        self.pending.discard(QuoteCache.key(self._session(route, *session)))
+
+    def _claim(self, query):
+        # Returns True when the session has to be published now. Sessions are only registered once published,
+        # so one sent by another query while this one still held it back is waited for instead.
+        key = QuoteCache.key(query)
+        with REGISTRY.lock:
+            quote = self.cache.get(key)
+            attached = quote is None and REGISTRY.attach(key, self.uuid, self.dispatcher.queue)
+        if quote is not None:
+            self.pending.discard(key)
+            self._add_result(dict(quote, query=query))
+            self._checkpoint(dict(quote, query=query))
+        return quote is None and not attached
 
+    def on_reply(self, result):
+        with self.lock:
+            key = QuoteCache.key(result['query'])
+            if result.get('partial'):
+                self.partials[key] = result
+            else:
+                self.partials.pop(key, None)
+                if key in self.pending:
+                    self.pending.remove(key)
+                    self._add_result(result)
+                    if not result.get('failed'):
+                        self._checkpoint(result)
+                if key in self.in_flight:
+                    self.in_flight.remove(key)
+                    self._send_backlog()
+
+            if not self.pending:
+                self._finish()
+            elif self.progress:
+                self._report_progress()
+
+    def _dispatch(self, query):
+        # Returns True when the session has to be created. Sessions another query holds back in its backlog are
+        # planned here too, at this query's priority, whichever query publishes first creates them.
+        self.total_sessions += 1
+        key = QuoteCache.key(query)
+        if key in self.completed:
+            self._add_result(dict(self.completed[key], query=query))
+            return False
+        with REGISTRY.lock:
+            quote = self.cache.get(key)
+            attached = quote is None and REGISTRY.join(key, self.uuid, self.dispatcher.queue)
+
+        if quote is not None:
+            self._add_result(dict(quote, query=query))
+            self._checkpoint(dict(quote, query=query))
+            return False
+        self.pending.add(key)
+        return not attached
+
+    @staticmethod
+    def _session(route, start_date, end_date):
+        query = {
+            'origin': route[0],
+            'destination': route[1],
+            'start_date': start_date
+        }
+        if end_date:
+            query['end_date'] = end_date
+        return query
+
+    def _session_dates(self):
+        current = self.start_date
         while current <= self.end_date:
-            message = {
-                'api_key': self.api_keys[self.pending_sessions % len(self.api_keys)],
-                'start_date': str(current),
-                'origin': self.origin,
-                'destination': self.destination
-            }
             if self.min_days:
                 for i in range(self.min_days, self.max_days + 1):
-                    message.update({
-                        'api_key': self.api_keys[self.pending_sessions % len(self.api_keys)],
-                        'end_date': str(current + datetime.timedelta(days=i))
-                    })
-                    logger.info(f"{current} {i}")
-                    self._send_message(message)
-                    self.pending_sessions += 1
+                    yield str(current), str(current + datetime.timedelta(days=i))
             else:
-                self._send_message(message)
-                self.pending_sessions += 1
-
+                yield str(current), None
             current += datetime.timedelta(days=1)
 
-        while self.pending_sessions:
-            self.connection.process_data_events()
+    @staticmethod
+    def _build_result(flight, query):
+        price, airlines = flight
+        return Result(
+            price=price,
+            airlines=tuple(airlines),
+            origin=query['origin'],
+            destination=query['destination'],
+            start_date=query['start_date'],
+            end_date=query.get('end_date', None)
+        )
+
+    def _add_result(self, result):
+        if result['direct']:
+            self.directs.push(result['direct'][0], self._build_result(result['direct'], result['query']))
+        if result['with_stops']:
+            self.with_stops.push(result['with_stops'][0], self._build_result(result['with_stops'], result['query']))
+
+    def _checkpoint(self, result):
+        if self.checkpoint:
+            self.checkpoint(result['query'], result['direct'], result['with_stops'])
+
+    def _report_progress(self):
+        now = time.monotonic()
+        if now - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = now
+
+        directs, with_stops = self.directs.items(), self.with_stops.items()
+        for r in self.partials.values():
+            if r['direct']:
+                directs.append(self._build_result(r['direct'], r['query']))
+            if r['with_stops']:
+                with_stops.append(self._build_result(r['with_stops'], r['query']))
+        directs.sort()
+        with_stops.sort()
+        self.dispatcher.call(
+            self.progress,
+            directs[:self.top_k],
+            with_stops[:self.top_k],
+            self.total_sessions - len(self.pending),
+            self.total_sessions
+        )
+
+    def _finish(self):
+        elapsed = time.monotonic() - self.created_at
+        if self.planner.pruned:
+            logger.info(f'Skipped {self.planner.pruned} of {self.total_sessions} sessions '
+                        f'from {self.origin} to {self.destination} that could not beat the results')
+        QUERY_SECONDS.labels(self.query_class).observe(elapsed)
+        trace('query', self.uuid, elapsed)
+        self.dispatcher.finish(self, self.directs.items(), self.with_stops.items())
+
+    def _browse_quotes(self, route, outbound, inbound=None):
+        url = f"{self.api_url}/apiservices/browsequotes/v1.0/ES/EUR/es-ES/" \
+              f"{route[0]}/{route[1]}/{outbound}"
+        if inbound:
+            url += f"/{inbound}"
+        headers = {
+            'x-rapidapi-host': "skyscanner-skyscanner-flight-search-v1.p.rapidapi.com"
+        }
+        response = json.loads(self.dispatcher.request("GET", url, headers).text)
+
+        quotes = {}
+        for quote in response.get('Quotes', []):
+            start_date = quote['OutboundLeg']['DepartureDate'][:10]
+            end_date = quote['InboundLeg']['DepartureDate'][:10] if 'InboundLeg' in quote else None
+            quotes[start_date, end_date] = min(quote['MinPrice'], quotes.get((start_date, end_date), quote['MinPrice']))
+        return quotes
+
+    def _price_bounds(self, dates, browse):
+        # Prices observed recently come for free, the rest are estimated with one browse call per route and month pair.
+        # Returns the cheapest price known of every (route, dates) and whether the browse calls succeeded.
+        wanted = set(dates)
+        bounds = {}
+        for route in self.routes:
+            quotes = self.history(*route) if self.history else {}
+            bounds.update(((route, d), price) for d, price in quotes.items() if d in wanted)
+        if not browse:
+            return bounds, False
+        try:
+            for route in self.routes:
+                missing = [d for d in dates if (route, d) not in bounds]
+                outbound_months = sorted({start_date[:7] for start_date, _ in missing})
+                inbound_months = sorted({end_date[:7] for _, end_date in missing if end_date}) or [None]
+                for outbound in outbound_months:
+                    for inbound in inbound_months:
+                        for d, price in self._browse_quotes(route, outbound, inbound).items():
+                            if d in wanted:
+                                bounds[route, d] = min(price, bounds.get((route, d), price))
+        except Exception as e:
+            logger.warning(f'Could not browse quotes, every date will be priced: {e}')
+            return bounds, False
+        return bounds, True
+
+    def expected_class(self):
+        # Known before the query starts, prescreening keeps at most prescreen_top_n of its sessions
+        sessions = len(self.routes) * sum(1 for _ in self._session_dates())
+        if self.prescreen_top_n:
+            sessions = min(sessions, self.prescreen_top_n)
+        return query_class(sessions, self.dispatcher.config)
+
+    def _prescreen(self, candidates, bounds):
+        # Browse quotes are sparse, dates without one fill the slots the quoted dates leave, in their own order
+        ranked = sorted((bounds[c], c) for c in candidates if c in bounds)
+        if not ranked:
+            return candidates
+        kept = ([c for _, c in ranked] + [c for c in candidates if c not in bounds])[:self.prescreen_top_n]
+        logger.info(f'Prescreened {len(kept)} of {len(candidates)} sessions from {self.origin} to {self.destination}, '
+                    f'{min(len(ranked), len(kept))} of them with a known price')
+        return kept
+
+    def start(self):
+        dates = list(self._session_dates())
+        candidates = [(route, d) for route in self.routes for d in dates]
+        # Browsing costs a call per route and month pair, it only pays off when prescreening or for sweeps, which hold
+        # sessions back in their window and prune them. Interactive queries send everything at once with history only.
+        prescreen = self.prescreen_top_n and len(candidates) > self.prescreen_top_n
+        browse = prescreen or query_class(len(candidates), self.dispatcher.config) == BULK
+        with span('prescreen', self.uuid):
+            bounds, browsed = self._price_bounds(dates, browse)
+        if prescreen and browsed:
+            candidates = self._prescreen(candidates, bounds)
+
+        with self.lock:
+            sessions = []
+            for route, (start_date, end_date) in candidates:
+                if self._dispatch(self._session(route, start_date, end_date)):
+                    sessions.append((bounds.get((route, (start_date, end_date))), route, [start_date, end_date]))
+
+            self.query_class = query_class(len(sessions), self.dispatcher.config)
+            if self.query_class == INTERACTIVE:
+                self.planner.batch_size = self.interactive_batch_size
+            self.planner.extend(sessions)
+            self._send_backlog()
+            logger.info(f'Dispatched {len(sessions)} of {self.total_sessions} sessions over {len(self.routes)} routes '
+                        f'from {self.origin} to {self.destination} as {self.query_class}')
+
+            if not self.pending:
+                self._finish()
 
 
 class Result:
+    __slots__ = ('price', 'airlines', 'origin', 'destination', 'start_date', 'end_date')
+
     def __init__(self, price, airlines, origin, destination, start_date, end_date=None):
         self.price = price
         self.airlines = airlines
@@ -0,0 +1,188 @@
+import itertools
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from prometheus_client.parser import text_string_to_metric_families
+
+from .base import *
+from .metrics import METRICS_PORT_RANGE, POOL_WORKERS, WORKER_RESTARTS, serve
+from .sharding import MAKE_QUEUE, POLL_QUEUE, bind_make_queue, queue_name, sharded, unbind_make_queue
+
+LOGS_DIR = 'logs'
+
+
+class Pool:
+    def __init__(self, name, command, queue, minimum, maximum):
+        self.name = name
+        self.command = command
+        self.queue = queue
+        self.minimum = minimum
+        self.maximum = maximum
+        self.workers = []
+        self.draining = []  # workers finishing their current message after a SIGTERM
+        self.last_scale_down = 0
+        self._ids = itertools.count()
+
+    def _spawn(self):
+        log = open(os.path.join(LOGS_DIR, f'log_{self.name}{next(self._ids)}.txt'), 'w')
+        self.workers.append(subprocess.Popen(self.command, stderr=log))
+        log.close()
+
+    def reap(self):
+        for worker in [w for w in self.workers if w.poll() is not None]:
+            logger.warning(f'{self.name} {worker.pid} died with code {worker.returncode}, replacing it')
+            WORKER_RESTARTS.labels(self.name).inc()
+            self.workers.remove(worker)
+        self.draining = [w for w in self.draining if w.poll() is None]
+
+    def scale_to(self, size):
+        size = max(self.minimum, min(self.maximum, size))
+        if size != len(self.workers):
+            logger.info(f'Scaling {self.name} pool from {len(self.workers)} to {size} workers')
+        while len(self.workers) < size:
+            self._spawn()
+        while len(self.workers) > size:
+            worker = self.workers.pop()
+            worker.send_signal(signal.SIGTERM)
+            self.draining.append(worker)
+        POOL_WORKERS.labels(self.name).set(len(self.workers))
+
+    def stop(self, timeout):
+        for worker in self.workers:
+            worker.send_signal(signal.SIGTERM)
+        self.draining += self.workers
+        self.workers = []
+        deadline = time.monotonic() + timeout
+        for worker in self.draining:
+            try:
+                worker.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                logger.warning(f'{self.name} {worker.pid} did not drain in time, killing it')
+                worker.kill()
+        self.draining = []
+
+
+class Supervisor(BaseWorker):
+    # Sizes the maker and poller pools after their backlog, the API quota and the CPU left on the host
+    def __init__(self, config, config_path):
+        super().__init__(config)
+        self.interval = config.get('supervisor-interval', SUPERVISOR_INTERVAL)
+        self.backlog = config.get('worker-backlog', WORKER_BACKLOG)
+        self.max_cpu_load = config.get('max-cpu-load', MAX_CPU_LOAD)
+        self.max_throttled_ratio = config.get('max-throttled-ratio', MAX_THROTTLED_RATIO)
+        self.scale_down_delay = config.get('scale-down-delay', SCALE_DOWN_DELAY)
+        self.stopping = False
+        self.requests = {}  # metrics port -> (requests, 429s) last scraped
+
+        if config.get('async-workers'):
+            commands = {name: [sys.executable, '-m', 'api.aio', name, config_path] for name in ('maker', 'poller')}
+        else:
+            commands = {name: [sys.executable, '-m', f'api.{name}', config_path] for name in ('maker', 'poller')}
+        self.pools = [
+            Pool('maker', commands['maker'], queue_name(MAKE_QUEUE, config),
+                 config.get('maker-min-workers', MAKER_MIN_WORKERS),
+                 config.get('maker-max-workers', MAKER_MAX_WORKERS)),
+            Pool('poller', commands['poller'], queue_name(POLL_QUEUE, config),
+                 config.get('poller-min-workers', POLLER_MIN_WORKERS),
+                 config.get('poller-max-workers', POLLER_MAX_WORKERS))
+        ]
+        for pool in self.pools:
+            self.channel.queue_declare(queue=pool.queue, durable=True, arguments=QUEUE_ARGUMENTS)
+        if sharded(config):
+            bind_make_queue(self.channel, config)
+
+    def _depth(self, queue):
+        return self.channel.queue_declare(queue=queue, durable=True, arguments=QUEUE_ARGUMENTS).method.message_count
+
+    def _cpu_busy(self):
+        return os.getloadavg()[0] / os.cpu_count() > self.max_cpu_load
+
+    def _throttled(self):
+        # Share of 429s the workers got since the last check, read from their metrics endpoints
+        port = self.config.get('metrics-port')
+        if port is None:
+            return False
+        requests = throttled = 0
+        for candidate in range(port, port + min(METRICS_PORT_RANGE, sum(len(p.workers) for p in self.pools) + 2)):
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{candidate}/metrics', timeout=1) as response:
+                    text = response.read().decode()
+            except OSError:
+                continue
+            total = limited = 0
+            for family in text_string_to_metric_families(text):
+                for sample in family.samples:
+                    if sample.name == 'skyscanner_api_requests_total':
+                        total += sample.value
+                        limited += sample.value if sample.labels['status'] == '429' else 0
+            previous_total, previous_limited = self.requests.get(candidate, (0, 0))
+            if total < previous_total:  # the worker on that port was restarted
+                previous_total = previous_limited = 0
+            requests += total - previous_total
+            throttled += limited - previous_limited
+            self.requests[candidate] = (total, limited)
+        return requests > 0 and throttled / requests > self.max_throttled_ratio
+
+    def _target(self, pool, depth, throttled, busy):
+        current = len(pool.workers)
+        wanted = math.ceil(depth / self.backlog)
+        if throttled:
+            # More workers would only be throttled too, give some quota back instead
+            wanted = current - 1
+        elif busy:
+            wanted = min(wanted, current)
+        if wanted >= current:
+            return wanted
+        if time.monotonic() - pool.last_scale_down < self.scale_down_delay:
+            return current
+        pool.last_scale_down = time.monotonic()
+        return current - 1
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        os.makedirs(LOGS_DIR, exist_ok=True)
+        for pool in self.pools:
+            pool.scale_to(pool.minimum)
+
+        while not self.stopping:
+            throttled, busy = self._throttled(), self._cpu_busy()
+            for pool in self.pools:
+                pool.reap()
+                depth = self._depth(pool.queue)
+                pool.scale_to(self._target(pool, depth, throttled, busy))
+                logger.info(f'{pool.name}: {depth} messages waiting, {len(pool.workers)} workers, '
+                            f'{len(pool.draining)} draining')
+            self.connection.sleep(self.interval)
+
+        drain_timeout = self.config.get('drain-timeout', DRAIN_TIMEOUT)
+        if sharded(self.config):
+            # The shard leaves the ring first, its workers then empty the queues it was already given
+            logger.info('Leaving the shard ring, emptying the queues of the shard')
+            unbind_make_queue(self.channel, self.config)
+            deadline = time.monotonic() + drain_timeout
+            while any(self._depth(pool.queue) for pool in self.pools) and time.monotonic() < deadline:
+                for pool in self.pools:
+                    pool.reap()
+                    pool.scale_to(len(pool.workers))
+                self.connection.sleep(1)
+
+        logger.info('Stopping, draining every worker')
+        for pool in self.pools:
+            pool.stop(drain_timeout)
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as file:
+        config = json.load(file)
+        serve(config)
+        Supervisor(config, sys.argv[1]).run()
@@ -0,0 +1,29 @@
+import heapq
+import itertools
+
+
+class TopK:
+    def __init__(self, k):
+        self.k = k
+        self._heap = []  # max-heap on price, its root is the worst result kept
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    @property
+    def threshold(self):
+        # Price a new result has to beat to get in, None while there is still room
+        if len(self._heap) < self.k:
+            return None
+        return -self._heap[0][0]
+
+    def push(self, price, item):
+        entry = (-price, next(self._counter), item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+        elif price < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, entry)
+
+    def items(self):
+        return [item for _, _, item in sorted(self._heap, key=lambda e: (-e[0], e[1]))]
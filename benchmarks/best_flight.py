@@ -0,0 +1,62 @@
+import sys
+import timeit
+
+from api.itineraries import Columns
+from benchmarks.fixtures import load
+
+REPEAT = 7
+
+
+def legacy_best_flights(response):
+    # Reduction the poller used before the columnar one, kept as the baseline
+    def get_best_flight(itineraries, flights):
+        best = None
+        for itinerary in itineraries:
+            out_id = itinerary['OutboundLegId']
+            in_id = itinerary.get('InboundLegId')
+            if out_id not in flights or (in_id and in_id not in flights):
+                continue
+            for p in itinerary['PricingOptions']:
+                if not best or p['Price'] < best[0]:
+                    airlines = set(flights[out_id])
+                    if in_id:
+                        airlines.update(set(flights[in_id]))
+                    best = (p['Price'], tuple(airlines))
+        return best
+
+    airlines = {carrier['Id']: carrier['Name'] for carrier in response['Carriers']}
+    direct_flights, stops_flights = {}, {}
+    for leg in response['Legs']:
+        flights = tuple(airlines[x] for x in leg['Carriers'])
+        if not leg['Stops']:
+            direct_flights[leg['Id']] = flights
+        else:
+            stops_flights[leg['Id']] = flights
+    return (get_best_flight(response['Itineraries'], direct_flights),
+            get_best_flight(response['Itineraries'], stops_flights))
+
+
+def columnar_best_flights(response):
+    return Columns.from_response(response).best_flights()
+
+
+def best_time(fn, number):
+    # Best of several runs, the others mostly measure whatever else the machine was doing
+    return min(timeit.repeat(fn, number=number, repeat=REPEAT)) / number
+
+
+def main(paths):
+    for name, response in load(paths):
+        legacy = legacy_best_flights(response)
+        columnar = columnar_best_flights(response)
+        for old, new in zip(legacy, columnar):
+            assert (old and old[0]) == (new and new[0][0]), f'{name}: {old} != {new}'
+
+        n = max(1, 20000 // len(response['Itineraries']))
+        legacy_time = best_time(lambda: legacy_best_flights(response), n)
+        columnar_time = best_time(lambda: columnar_best_flights(response), n)
+        print(f'{name:>20}: {len(response["Itineraries"]):6} itineraries  '
+              f'legacy {legacy_time * 1000:8.2f}ms  columnar {columnar_time * 1000:8.2f}ms')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
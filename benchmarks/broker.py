@@ -0,0 +1,171 @@
+import bisect
+import collections
+import itertools
+import queue
+import threading
+import time
+import types
+import zlib
+
+import pika
+
+DELIVERY_TIMEOUT = 0.01
+RING_POINTS = 100  # points per unit of weight on a consistent-hash ring
+
+
+class Broker:
+    # In-process stand-in for RabbitMQ: named priority queues shared by every connection and consistent-hash
+    # exchanges, no persistence or requeues
+    def __init__(self):
+        self._queues = {}
+        self._bindings = collections.defaultdict(dict)  # exchange -> queue -> weight
+        self._rings = {}
+        self.published = collections.Counter()
+        self._lock = threading.Lock()
+        self._names = itertools.count()
+        self._consumers = {}
+        self._sequence = itertools.count()
+
+    def queue(self, name):
+        with self._lock:
+            if name not in self._queues:
+                self._queues[name] = queue.PriorityQueue()
+            return self._queues[name]
+
+    def declare(self, name=''):
+        name = name or f'amq.gen-{next(self._names)}'
+        self.queue(name)
+        return name
+
+    def bind(self, exchange, queue, weight):
+        with self._lock:
+            self._bindings[exchange][queue] = weight
+            self._rings.pop(exchange, None)
+
+    def unbind(self, exchange, queue):
+        with self._lock:
+            self._bindings[exchange].pop(queue, None)
+            self._rings.pop(exchange, None)
+
+    def _route(self, exchange, routing_key):
+        with self._lock:
+            if exchange not in self._rings:
+                self._rings[exchange] = sorted(
+                    (zlib.crc32(f'{queue}:{i}'.encode()), queue)
+                    for queue, weight in self._bindings[exchange].items()
+                    for i in range(weight * RING_POINTS)
+                )
+            ring = self._rings[exchange]
+        if not ring:
+            return None
+        return ring[bisect.bisect(ring, (zlib.crc32(routing_key.encode()),)) % len(ring)][1]
+
+    def publish(self, routing_key, properties, body, exchange=''):
+        name = self._route(exchange, routing_key) if exchange else routing_key
+        if name is None:
+            return False  # unroutable, dropped like RabbitMQ does unless the publisher asked for it back
+        self.published[name] += 1
+        self.queue(name).put((-(properties.priority or 0), next(self._sequence), properties, body))
+        return True
+
+    def depth(self, name):
+        return self.queue(name).qsize()
+
+    def consume(self, name):
+        with self._lock:
+            self._consumers[name] = self._consumers.get(name, 0) + 1
+
+    def consumers(self, name):
+        return self._consumers.get(name, 0)
+
+    def connect(self):
+        return Connection(self)
+
+
+class Connection:
+    # The subset of pika.BlockingConnection the workers use
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+        self._callbacks = queue.Queue()
+        self._channel = Channel(self)
+
+    def channel(self):
+        return self._channel
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.put(callback)
+
+    def call_later(self, delay, callback):
+        timer = threading.Timer(delay, self.add_callback_threadsafe, (callback,))
+        timer.daemon = True
+        timer.start()
+
+    def process_data_events(self, time_limit=0):
+        while not self._callbacks.empty():
+            self._callbacks.get()()
+        self._channel.deliver()
+
+    def close(self):
+        self.is_closed = True
+
+
+class Channel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self._consumers = []
+        self._returns = []
+        self._tags = itertools.count(1)
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def queue_declare(self, queue='', **kwargs):
+        name = self.broker.declare(queue)
+        return types.SimpleNamespace(method=types.SimpleNamespace(
+            queue=name,
+            message_count=self.broker.depth(name),
+            consumer_count=self.broker.consumers(name)
+        ))
+
+    def basic_consume(self, queue, on_message_callback, **kwargs):
+        self.broker.consume(queue)
+        self._consumers.append((queue, on_message_callback))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        properties = properties or pika.BasicProperties()
+        if not self.broker.publish(routing_key, properties, body, exchange) and mandatory:
+            method = types.SimpleNamespace(exchange=exchange, routing_key=routing_key, reply_code=312)
+            for callback in self._returns:
+                self.connection.add_callback_threadsafe(lambda c=callback: c(self, method, properties, body))
+
+    def add_on_return_callback(self, callback):
+        self._returns.append(callback)
+
+    def exchange_declare(self, exchange, exchange_type='direct', **kwargs):
+        pass
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        self.broker.bind(exchange, queue, int(routing_key or 1))
+
+    def queue_unbind(self, queue, exchange, routing_key=None, **kwargs):
+        self.broker.unbind(exchange, queue)
+
+    def basic_ack(self, delivery_tag):
+        pass
+
+    def deliver(self):
+        for name, callback in self._consumers:
+            try:
+                _, _, properties, body = self.broker.queue(name).get(timeout=DELIVERY_TIMEOUT)
+            except queue.Empty:
+                continue
+            callback(self, types.SimpleNamespace(delivery_tag=next(self._tags), routing_key=name), properties, body)
+
+    def start_consuming(self):
+        while not self.connection.is_closed:
+            self.connection.process_data_events(time_limit=None)
@@ -0,0 +1,89 @@
+import argparse
+import json
+import time
+
+import pika
+
+from api.codec import JSON, MSGPACK, decode, encode, pack_session
+
+QUERY = {
+    'api_key': '0123456789abcdef0123456789abcdef0123456789abcdef01',
+    'origin': 'MAD-sky',
+    'destination': 'LOND-sky',
+    'start_date': '2020-03-01',
+    'end_date': '2020-03-08'
+}
+
+
+def legacy_messages():
+    return [
+        ({'location': 'ab5b948d616e41fb954a4a2f6b8b32e1_ecilpojl', 'query': QUERY}, None),
+        ({'direct': [40.5, ['Iberia']], 'with_stops': [31.2, ['Ryanair', 'easyJet']], 'query': QUERY}, None)
+    ]
+
+
+def compact_messages(content_type):
+    session = pack_session(QUERY)
+    return [
+        ({'location': 'ab5b948d616e41fb954a4a2f6b8b32e1_ecilpojl', 'session': session}, content_type),
+        ({'direct': [40.5, ['Iberia']], 'with_stops': [31.2, ['Ryanair', 'easyJet']], 'session': session}, content_type)
+    ]
+
+
+CASES = {
+    'legacy json': (legacy_messages, lambda obj, _: json.dumps(obj).encode(), lambda body, _: json.loads(body)),
+    'compact json': (lambda: compact_messages(JSON), encode, decode),
+    'compact msgpack': (lambda: compact_messages(MSGPACK), encode, decode)
+}
+
+
+def bench_codec(n):
+    for name, (messages, dumps, loads) in CASES.items():
+        messages = messages()
+        size = sum(len(dumps(obj, ct)) for obj, ct in messages) / len(messages)
+        start = time.perf_counter()
+        for i in range(n):
+            obj, ct = messages[i % len(messages)]
+            loads(dumps(obj, ct), ct)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>16}: {n / elapsed:10.0f} encode+decode/s  {size:6.0f} bytes/message')
+
+
+def bench_broker(n, host, user, password):
+    # Publishes n messages to a throwaway queue and consumes them back with each codec
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        host=host,
+        credentials=pika.PlainCredentials(user, password)
+    ))
+    channel = connection.channel()
+    queue = channel.queue_declare(queue='', exclusive=True).method.queue
+    for name, (messages, dumps, loads) in CASES.items():
+        messages = messages()
+        start = time.perf_counter()
+        for i in range(n):
+            obj, ct = messages[i % len(messages)]
+            channel.basic_publish(exchange='', routing_key=queue, body=dumps(obj, ct),
+                                  properties=pika.BasicProperties(content_type=ct or JSON))
+        consumed = 0
+        for method, props, body in channel.consume(queue, auto_ack=True):
+            loads(body, props.content_type)
+            consumed += 1
+            if consumed == n:
+                break
+        channel.cancel()
+        elapsed = time.perf_counter() - start
+        print(f'{name:>16}: {n / elapsed:10.0f} publish+consume/s')
+    connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000)
+    parser.add_argument('--rabbitmq-host')
+    parser.add_argument('--rabbitmq-user', default='guest')
+    parser.add_argument('--rabbitmq-password', default='guest')
+    args = parser.parse_args()
+
+    bench_codec(args.n)
+    if args.rabbitmq_host:
+        bench_broker(args.n, args.rabbitmq_host, args.rabbitmq_user, args.rabbitmq_password)
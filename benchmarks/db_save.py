@@ -0,0 +1,84 @@
+import argparse
+import datetime
+import importlib
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from peewee import SqliteDatabase
+
+
+def stored(model):
+    # Saves that reached the table: every row was inserted once and updated once when it has results
+    return model.Query.select().count() + model.Query.select().where(model.Query.results_date.is_null(False)).count()
+
+
+def run(model, threads, saves, save, flush=None):
+    latencies, errors = [], []
+
+    def worker(user_id):
+        for _ in range(saves):
+            # A query is inserted when the conversation ends and updated when the results arrive
+            query = model.Query(user_id=user_id, username=f'user {user_id}', creation_date=datetime.datetime.now())
+            start = time.perf_counter()
+            try:
+                save(query)
+                query.results_date = datetime.datetime.now()
+                save(query)
+            except Exception as e:
+                errors.append(e)
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    before = stored(model)
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    if flush:
+        flush()
+    elapsed = time.perf_counter() - start
+    # Write-behind callers never see their errors, only what is in the table counts
+    done = stored(model) - before
+    latencies = sorted(latencies) or [float('nan')]
+    lost = 2 * threads * saves - done
+    return done / elapsed, lost, len(errors), statistics.mean(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def direct_save(model):
+    # The pool has fewer connections than the benchmark has threads, each save returns its own
+    def save(query):
+        with model.db.connection_context():
+            query.save()
+
+    return save
+
+
+def main(threads, saves):
+    # model creates its database in the working directory on import
+    os.chdir(tempfile.mkdtemp())
+    model = importlib.import_module('model')
+
+    legacy = SqliteDatabase('legacy.sqlite3', check_same_thread=False)
+    with legacy.bind_ctx([model.Query]):
+        legacy.create_tables([model.Query])
+        cases = [('save() per call', run(model, threads, saves, lambda q: q.save()))]
+    cases.append(('save() on WAL', run(model, threads, saves, direct_save(model))))
+    cases.append(('write-behind', run(model, threads, saves, model.WRITER.save, model.WRITER.flush)))
+
+    for name, (throughput, lost, errors, mean, p99) in cases:
+        print(f'{name:>16}: {throughput:10.0f} saves/s  {lost:6d} lost ({errors} errors)  '
+              f'caller mean {mean * 1000:8.3f} ms  p99 {p99 * 1000:8.3f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--saves', type=int, default=200)
+    args = parser.parse_args()
+
+    main(args.threads, args.saves)
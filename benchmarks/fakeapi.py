@@ -0,0 +1,163 @@
+import argparse
+import collections
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.fixtures import pricing_response
+
+LAST_PAGE_ITINERARIES = 10  # short enough for the workers to stop walking pages
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Workers drop kept-alive connections when their pools are full, that is not an error of the API
+        pass
+
+
+class FakeApi:
+    # Local stand-in for the RapidAPI endpoints the workers call, with tunable latency, pending phases and 429s
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, pending_polls=2, rate_limited=0.0, retry_after=0.5,
+                 itineraries=100, pages=1, round_trip=True, seed=0):
+        self.latency = latency
+        self.pending_polls = pending_polls
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.pages = pages
+        self.rng = random.Random(seed)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.sessions = {}  # session id -> polls answered so far
+
+        # Payloads are serialized once, their size is what the workers have to parse
+        self.pending = json.dumps(pricing_response(itineraries // 2, round_trip, 'UpdatesPending', seed)).encode()
+        self.complete = json.dumps(pricing_response(itineraries, round_trip, 'UpdatesComplete', seed)).encode()
+        self.last_page = json.dumps(
+            pricing_response(LAST_PAGE_ITINERARIES, round_trip, 'UpdatesComplete', seed)
+        ).encode()
+
+        self.server = Server((host, port), self._handler())
+        self.url = f'http://{host}:{self.server.server_address[1]}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, endpoint, status):
+        with self.lock:
+            self.calls[endpoint, status] += 1
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, endpoint, status, body=b'', headers=None):
+                api.count(endpoint, status)
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _throttled(self, endpoint):
+                time.sleep(api.latency * (0.5 + api.rng.random()))
+                if api.rate_limited and api.rng.random() < api.rate_limited:
+                    self._reply(endpoint, 429, b'{"message": "Too many requests"}',
+                                {'Retry-After': str(api.retry_after)})
+                    return True
+                return False
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not self.path.startswith('/apiservices/pricing/v1.0'):
+                    return self._reply('unknown', 404)
+                if self._throttled('create'):
+                    return
+                session = uuid.uuid4().hex
+                with api.lock:
+                    api.sessions[session] = 0
+                self._reply('create', 201, b'{}', {'Location': f'{api.url}/apiservices/pricing/uk2/v1.0/{session}'})
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith('/apiservices/pricing/uk2/v1.0/'):
+                    self._poll(url.path.split('/')[-1], int(query.get('pageIndex', ['0'])[0]))
+                elif url.path.startswith('/apiservices/autosuggest/'):
+                    if not self._throttled('autosuggest'):
+                        place = query.get('query', [''])[0]
+                        body = {'Places': [{'PlaceId': f'{place[:4].upper()}-sky', 'CityId': f'{place[:4].upper()}-sky',
+                                            'PlaceName': place}]}
+                        self._reply('autosuggest', 200, json.dumps(body).encode())
+                elif url.path.startswith('/apiservices/browsequotes/'):
+                    if not self._throttled('browse'):
+                        self._reply('browse', 200, json.dumps(self._browse(url.path.split('/')[-2:])).encode())
+                else:
+                    self._reply('unknown', 404)
+
+            def _poll(self, session, page_index):
+                endpoint = 'poll' if page_index == 0 else 'page'
+                if self._throttled(endpoint):
+                    return
+                with api.lock:
+                    if session not in api.sessions:
+                        return self._reply(endpoint, 410)
+                    polls = api.sessions[session] = api.sessions[session] + (page_index == 0)
+                if polls <= api.pending_polls:
+                    body = api.pending
+                elif page_index < api.pages:
+                    body = api.complete
+                else:
+                    body = api.last_page
+                self._reply(endpoint, 200, body)
+
+            @staticmethod
+            def _browse(path):
+                months = [p for p in path if re.fullmatch(r'\d{4}-\d{2}', p)]
+                quotes = []
+                for outbound, day in itertools.product(months[:1], range(1, 29)):
+                    quote = {'MinPrice': round(api.rng.uniform(20, 400), 2),
+                             'OutboundLeg': {'DepartureDate': f'{outbound}-{day:02d}T00:00:00'}}
+                    if len(months) > 1:
+                        quote['InboundLeg'] = {'DepartureDate': f'{months[1]}-{day:02d}T00:00:00'}
+                    quotes.append(quote)
+                return {'Quotes': quotes}
+
+        return Handler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--pending-polls', type=int, default=2)
+    parser.add_argument('--rate-limited', type=float, default=0.0, help='fraction of requests answered with a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--itineraries', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=1)
+    args = parser.parse_args()
+
+    api = FakeApi(args.host, args.port, args.latency, args.pending_polls, args.rate_limited, args.retry_after,
+                  args.itineraries, args.pages)
+    print(f'Serving a fake Skyscanner API on {api.url}')
+    api.server.serve_forever()
@@ -0,0 +1,62 @@
+import json
+import random
+
+CARRIERS = ['Iberia', 'Vueling', 'Ryanair', 'easyJet', 'Air Europa', 'British Airways', 'Lufthansa', 'KLM',
+            'Air France', 'TAP Air Portugal', 'Norwegian', 'Wizz Air', 'Aer Lingus', 'ITA Airways', 'SWISS']
+
+
+def pricing_response(itineraries=1000, round_trip=True, status='UpdatesComplete', seed=0):
+    # Synthetic pricing/uk2 response shaped like the recorded ones, sized by its number of itineraries
+    rng = random.Random(seed)
+    carriers = [{'Id': 800 + i, 'Code': name[:2].upper(), 'Name': name, 'DisplayCode': name[:2].upper(),
+                 'ImageUrl': f'https://s1.apideeplink.com/images/airlines/{name[:2].upper()}.png'}
+                for i, name in enumerate(CARRIERS)]
+
+    n_legs = max(2, itineraries // 4)
+    legs, segments = [], []
+    for i in range(n_legs):
+        stops = [rng.randint(10000, 20000) for _ in range(rng.choice((0, 0, 1, 1, 2)))]
+        leg_carriers = [rng.choice(carriers)['Id'] for _ in range(len(stops) + 1)]
+        segment_ids = list(range(len(segments), len(segments) + len(stops) + 1))
+        for segment_id, carrier in zip(segment_ids, leg_carriers):
+            segments.append({'Id': segment_id, 'OriginStation': 13554, 'DestinationStation': 11235,
+                             'DepartureDateTime': '2020-03-01T07:35:00', 'ArrivalDateTime': '2020-03-01T09:40:00',
+                             'Carrier': carrier, 'OperatingCarrier': carrier, 'Duration': 125,
+                             'FlightNumber': str(rng.randint(100, 9999)), 'JourneyMode': 'Flight',
+                             'Directionality': 'Outbound'})
+        legs.append({'Id': f'13554-2003010735--{rng.randint(30000, 40000)}-{len(stops)}-11235-2003010940-{i}',
+                     'SegmentIds': segment_ids, 'OriginStation': 13554, 'DestinationStation': 11235,
+                     'Departure': '2020-03-01T07:35:00', 'Arrival': '2020-03-01T09:40:00', 'Duration': 125,
+                     'JourneyMode': 'Flight', 'Stops': stops, 'Carriers': sorted(set(leg_carriers)),
+                     'OperatingCarriers': sorted(set(leg_carriers)), 'Directionality': 'Outbound',
+                     'FlightNumbers': [{'FlightNumber': '3162', 'CarrierId': c} for c in leg_carriers]})
+
+    results = []
+    for _ in range(itineraries):
+        itinerary = {'OutboundLegId': rng.choice(legs)['Id'], 'PricingOptions': [],
+                     'BookingDetailsLink': {'Uri': '/apiservices/pricing/v1.0/abc/booking', 'Body': 'x', 'Method': 'PUT'}}
+        if round_trip:
+            itinerary['InboundLegId'] = rng.choice(legs)['Id']
+        for _ in range(rng.randint(1, 4)):
+            itinerary['PricingOptions'].append({
+                'Agents': [rng.randint(2000000, 4000000)],
+                'QuoteAgeInMinutes': rng.randint(0, 60),
+                'Price': round(rng.uniform(20, 900), 2),
+                'DeeplinkUrl': 'http://partners.api.skyscanner.net/apiservices/deeplink/v2?_cje=' + 'x' * 200
+            })
+        results.append(itinerary)
+
+    return {'SessionKey': 'ab5b948d616e41fb954a4a2f6b8b32e1_ecilpojl_DCE634A426CBDE30CF2B7E8D41EA3B6D',
+            'Status': status, 'Itineraries': results, 'Legs': legs, 'Segments': segments,
+            'Carriers': carriers, 'Agents': [], 'Places': [], 'Currencies': []}
+
+
+def load(paths, sizes=(100, 1000, 5000)):
+    # Recorded responses when given, synthetic ones of each size otherwise
+    if paths:
+        for path in paths:
+            with open(path) as file:
+                yield path, json.load(file)
+    else:
+        for size in sizes:
+            yield f'synthetic-{size}', pricing_response(size)
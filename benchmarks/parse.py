@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from api.itineraries import Columns
+from benchmarks.fixtures import pricing_response
+
+SIZES = (1000, 5000, 20000)
+
+
+def parse_json(payload):
+    return Columns.from_response(json.loads(payload))
+
+
+def parse_orjson(payload):
+    return Columns.from_body(payload)
+
+
+def parse_stream(payload):
+    return Columns.from_stream(io.BytesIO(payload))
+
+
+METHODS = {
+    'json': parse_json,
+    'orjson': parse_orjson,
+    'stream': parse_stream
+}
+
+
+def measure(method, path):
+    # Runs in its own process so that peak RSS belongs to a single parse
+    with open(path, 'rb') as file:
+        payload = file.read()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    METHODS[method](payload)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+
+    tracemalloc.start()
+    METHODS[method](payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(json.dumps({'bytes': len(payload), 'seconds': elapsed, 'rss_kb': rss, 'peak_kb': peak // 1024}))
+
+
+def main(paths):
+    with tempfile.TemporaryDirectory() as tmp:
+        if not paths:
+            for size in SIZES:
+                paths.append(os.path.join(tmp, f'synthetic-{size}.json'))
+                with open(paths[-1], 'w') as file:
+                    json.dump(pricing_response(size), file)
+
+        for path in paths:
+            for method in METHODS:
+                output = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.parse', '--measure', method, path],
+                    capture_output=True, check=True, text=True
+                ).stdout
+                result = json.loads(output)
+                print(f'{os.path.basename(path):>22} ({result["bytes"] / 2 ** 20:6.1f} MiB) {method:>6}: '
+                      f'{result["seconds"] * 1000:8.1f}ms  peak RSS +{result["rss_kb"] / 1024:7.1f} MiB  '
+                      f'peak Python heap {result["peak_kb"] / 1024:7.1f} MiB')
+
+
+if __name__ == '__main__':
+    # Recorded responses may be given as arguments, synthetic ones are generated otherwise
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,142 @@
+import argparse
+import datetime
+import logging
+import resource
+import statistics
+import threading
+import time
+
+from api.dispatcher import Dispatcher
+from api.maker import Maker
+from api.poller import Poller
+from api.skyscanner import FlightQuery
+from benchmarks.broker import Broker
+from benchmarks.fakeapi import FakeApi
+
+
+def build_config(args, api_url):
+    return {
+        'rabbitmq-host': None,
+        'rabbitmq-user': None,
+        'rabbitmq-password': None,
+        'x-rapidapi-keys': [f'key-{i}' for i in range(args.keys)],
+        'api-key-rate': args.key_rate,
+        'api-key-burst': args.key_rate,
+        'api-url': api_url,
+        'poll-initial-wait': args.poll_wait,
+        'poll-max-wait': 4 * args.poll_wait,
+        'max-active-queries': args.queries,
+        'cache-ttl': 0 if args.no_cache else 30 * 60,
+        'sharding': bool(args.shards)
+    }
+
+
+def start_workers(config, broker, makers, pollers, shards):
+    # Every shard gets its own makers and pollers, consuming the queues of that shard only
+    configs = [dict(config, sharding=True, shard=f'shard{i}') for i in range(shards)] if shards else [config]
+    workers = []
+    for shard_config in configs:
+        workers += [Maker(shard_config, broker.connect()) for _ in range(makers)]
+        workers += [Poller(shard_config, broker.connect()) for _ in range(pollers)]
+    for worker in workers:
+        threading.Thread(target=worker.run, daemon=True).start()
+    return workers
+
+
+def run_queries(dispatcher, args):
+    # Queries spread over --routes routes, so lower values exercise the cache and in-flight sharing.
+    # With --origins every query leaves from that many neighbouring origins at once.
+    start_date = datetime.date.today() + datetime.timedelta(days=30)
+    latencies, queries, done = [], [], threading.Semaphore(0)
+
+    def report(started):
+        def callback(directs, with_stops, failed=False):
+            latencies.append(time.perf_counter() - started)
+            done.release()
+        return callback
+
+    start = time.perf_counter()
+    for i in range(args.queries):
+        query = {
+            'origin': [f'ORG{(i + j) % args.routes}-sky' for j in range(args.origins)],
+            'destination': 'DST-sky',
+            'start_date': start_date,
+            'end_date': start_date + datetime.timedelta(days=args.days - 1)
+        }
+        if args.min_days:
+            query['min_days'], query['max_days'] = args.min_days, args.max_days
+        fq = FlightQuery(dispatcher, query, report(time.perf_counter()))
+        dispatcher.submit(fq)
+        queries.append(fq)
+
+    for _ in range(args.queries):
+        if not done.acquire(timeout=args.timeout):
+            raise TimeoutError(f'Only {len(latencies)} of {args.queries} queries finished')
+    return time.perf_counter() - start, sorted(latencies), queries
+
+
+def main(args):
+    if not args.verbose:
+        logging.getLogger('api').setLevel(logging.ERROR)
+    api = None
+    if args.api_url:
+        api_url = args.api_url
+    else:
+        api = FakeApi(latency=args.latency, pending_polls=args.pending_polls, rate_limited=args.rate_limited,
+                      retry_after=args.retry_after, itineraries=args.itineraries, pages=args.pages,
+                      round_trip=bool(args.min_days)).start()
+        api_url = api.url
+
+    config = build_config(args, api_url)
+    broker = Broker()
+    start_workers(config, broker, args.makers, args.pollers, args.shards)
+    dispatcher = Dispatcher(config, broker.connect())
+    dispatcher.start()
+
+    elapsed, latencies, queries = run_queries(dispatcher, args)
+    sessions = sum(fq.total_sessions for fq in queries)
+    print(f'{args.queries} queries, {sessions} sessions, {args.makers} makers, {args.pollers} pollers'
+          + (f' on each of {args.shards} shards' if args.shards else ''))
+    print(f'  throughput: {args.queries / elapsed:8.2f} queries/s  {sessions / elapsed:8.2f} sessions/s')
+    pruned = sum(fq.planner.pruned for fq in queries)
+    if pruned:
+        print(f'  pruned:     {pruned / args.queries:8.2f} sessions/query')
+    print(f'  latency:    p50 {statistics.median(latencies):8.3f} s  '
+          f'p99 {latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]:8.3f} s')
+    if api:
+        for (endpoint, status), count in sorted(api.calls.items()):
+            print(f'  {endpoint:>11} {status}: {count / args.queries:8.2f} calls/query')
+    for queue, count in sorted(broker.published.items()):
+        if queue.startswith('skyscanner-poll'):
+            print(f'  {queue}: {count} sessions')
+    print(f'  peak RSS:   {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:8.1f} MiB'
+          + (' (fake API included)' if api else ''))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='End-to-end make, poll and reply benchmark without RapidAPI or RabbitMQ'
+    )
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--routes', type=int, default=20)
+    parser.add_argument('--days', type=int, default=5)
+    parser.add_argument('--origins', type=int, default=1, help='origins searched at once by every query')
+    parser.add_argument('--min-days', type=int, default=0)
+    parser.add_argument('--max-days', type=int, default=0)
+    parser.add_argument('--makers', type=int, default=4)
+    parser.add_argument('--pollers', type=int, default=10)
+    parser.add_argument('--shards', type=int, default=0, help='route sessions to this many shards by route')
+    parser.add_argument('--keys', type=int, default=4)
+    parser.add_argument('--key-rate', type=float, default=1000)
+    parser.add_argument('--poll-wait', type=float, default=0.05)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--timeout', type=float, default=600)
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--api-url', help='use an already running API instead of starting a fake one')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--pending-polls', type=int, default=2)
+    parser.add_argument('--rate-limited', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=0.5)
+    parser.add_argument('--itineraries', type=int, default=100)
+    parser.add_argument('--pages', type=int, default=1)
+    main(parser.parse_args())
@@ -1,15 +1,18 @@
 import datetime
+import functools
 import json
 import logging
-import threading
 
 from telegram import (ReplyKeyboardMarkup, ReplyKeyboardRemove)
+from telegram.error import TelegramError
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                           ConversationHandler)
 
 import model
+from api.dispatcher import Dispatcher
+from api.metrics import serve
 from api.skyscanner import FlightQuery
-from api.base import get_place
+from api.places import PlaceIndex
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -19,35 +22,216 @@ logger = logging.getLogger(__name__)
 
 ORIGIN, DESTINATION, TRIP_TYPE, START_DATE, END_DATE, MIN_DAYS, MAX_DAYS = range(7)
 
+HISTORY_DAYS = 7
+MAX_PLACES = 3  # origins or destinations of a single query, every pair of them is a route to search
+
 
 def _remove_previous_task(update):
     if update.effective_user.id in TASKS:
-        TASKS.pop(update.effective_user.id)
+        DISPATCHER.cancel(TASKS.pop(update.effective_user.id))
         update.message.reply_text('Your previous query has been cancelled.')
 
 
+def _format_flights(direct, with_stops):
+    flights = direct[:10] if direct else with_stops[:10]
+    if len({(f.origin, f.destination) for f in flights}) > 1:
+        return ''.join(f'{f.origin} to {f.destination}, {f}\n' for f in flights)
+    return ''.join(str(f) + '\n' for f in flights)
+
+
+def _lookup_places(update, max_places):
+    # Several places can be given separated by commas, returns their PlaceIds or None after telling what failed
+    names = [name.strip() for name in update.message.text.split(',') if name.strip()]
+    if not names:
+        update.message.reply_text('I need at least one place. Please try again...')
+        return None
+    if len(names) > max_places:
+        update.message.reply_text(
+            f'I can only search from or to {max_places} places at once. '
+            'Please try again with fewer places...'
+        )
+        return None
+    codes = []
+    for name in names:
+        code = PLACES.lookup(name)
+        if not code:
+            update.message.reply_text(
+                'It seems like you made a mistake spelling it or there are no flights from a city named '
+                f'{name}. '
+                'Try again with a different place...'
+            )
+            return None
+        codes.append(code)
+    return list(dict.fromkeys(codes))
+
+
+def _send_progress_message(update):
+    sent = {}
+
+    def progress(direct, with_stops, completed, total):
+        if not direct and not with_stops:
+            return
+        message = f'Best options found so far ({completed}/{total} searches finished):\n\n' + \
+                  _format_flights(direct, with_stops)
+        if message == sent.get('text'):
+            return
+        try:
+            if 'message' not in sent:
+                sent['message'] = update.message.reply_text(message)
+            else:
+                sent['message'].edit_text(message)
+            sent['text'] = message
+        except TelegramError as e:
+            logger.warning('Could not update progress message: "%s"', e)
+
+    return progress
+
+
+def _result_message(query, direct, with_stops):
+    if direct or with_stops:
+        message = 'Here are the best options I have found:\n\n'
+        message += _format_flights(direct, with_stops)
+        message += '\nYou can go to https://www.skyscanner.com/ to confirm a reservation if you wish.'
+    else:
+        message = f"I am sorry, there are no flights from {query.origin} to " \
+                  f"{query.destination} that meet the conditions you have specified. :'("
+    return message
+
+
+def _failed_message(query):
+    return f'Something went wrong while looking for flights from {query.origin} to {query.destination}. ' \
+           'Send /start to try again.'
+
+
+def _finish_query(query, failed):
+    # Failed queries are not resumed after a restart, their user has been told to start over
+    if failed:
+        query.cancelled = True
+    else:
+        query.results_date = datetime.datetime.now()
+    model.WRITER.save(query)
+
+
 def _send_result_message(update, context):
-    def report(direct, with_stops):
-        direct = direct[:10]
-        with_stops = with_stops[:10]
-        if direct or with_stops:
-            message = 'Here are the best options I have found:\n\n'
-            flights = direct if direct else with_stops
-            for f in flights:
-                message += str(f) + '\n'
-            message += '\nYou can go to https://www.skyscanner.com/ to confirm a reservation if you wish.'
-        else:
-            message = f"I am sorry, there are no flights from {context.chat_data['query'].origin} to " \
-                      f"{context.chat_data['query'].destination} that meet the conditions you have specified. :'("
-        update.message.reply_text(message)
+    def report(direct, with_stops, failed=False):
+        query = context.chat_data['query']
+        update.message.reply_text(_failed_message(query) if failed else _result_message(query, direct, with_stops))
         TASKS.pop(update.effective_user.id)
-        context.chat_data['query'].results_date = datetime.datetime.now()
-        context.chat_data['query'].save()
+        _finish_query(query, failed)
         logger.info('"%s" has received the result.', update.effective_user.full_name)
 
     return report
 
 
+def _checkpoint_session(query):
+    def checkpoint(session, direct, with_stops):
+        model.WRITER.submit(
+            model.Session.create,
+            query=query,
+            origin=session['origin'],
+            destination=session['destination'],
+            start_date=session['start_date'],
+            end_date=session.get('end_date', None),
+            direct=json.dumps(direct) if direct else None,
+            with_stops=json.dumps(with_stops) if with_stops else None
+        )
+
+    return checkpoint
+
+
+def _record_quotes(session, direct, with_stops):
+    # Prices observed by the pollers, cache hits and queries sharing a session add nothing new
+    model.WRITER.submit(model.Quote.record, [
+        {
+            'origin': session['origin'],
+            'destination': session['destination'],
+            'start_date': session['start_date'],
+            'end_date': session.get('end_date', None),
+            'direct': is_direct,
+            'price': flight[0],
+            'carriers': '-'.join(flight[1])
+        }
+        for is_direct, flight in ((True, direct), (False, with_stops)) if flight
+    ])
+
+
+def _price_history(origin, destination):
+    since = datetime.datetime.now() - datetime.timedelta(days=CONFIG.get('history-days', HISTORY_DAYS))
+    return model.Quote.cheapest_known(origin, destination, since)
+
+
+def _completed_sessions(query):
+    return {
+        (s.origin or query.origin_id, s.destination or query.destination_id, s.start_date, s.end_date): {
+            'direct': json.loads(s.direct) if s.direct else None,
+            'with_stops': json.loads(s.with_stops) if s.with_stops else None
+        }
+        for s in query.sessions
+    }
+
+
+def _notify(bot, user_id, text):
+    # Users may have blocked the bot meanwhile, their queries are resumed or cancelled all the same
+    try:
+        bot.send_message(user_id, text)
+    except TelegramError as e:
+        logger.warning('Could not notify user %s: "%s"', user_id, e)
+
+
+def _resume_queries(bot):
+    today = datetime.date.today()
+    for query in model.Query.unfinished():
+        if query.end_date < today:
+            query.cancelled = True
+            model.WRITER.save(query)
+            _notify(
+                bot,
+                query.user_id,
+                f'I was restarted while looking for flights from {query.origin} to {query.destination} '
+                'and your dates have already passed. Send /start to try again.'
+            )
+            continue
+
+        def report(direct, with_stops, failed=False, query=query):
+            message = _failed_message(query) if failed else _result_message(query, direct, with_stops)
+            _notify(bot, query.user_id, message)
+            TASKS.pop(query.user_id)
+            _finish_query(query, failed)
+            logger.info('"%s" has received the result of a resumed query.', query.username)
+
+        fq = FlightQuery(
+            DISPATCHER,
+            {
+                'origin': query.origin_id.split(','),
+                'destination': query.destination_id.split(','),
+                'start_date': max(query.start_date, today),
+                'end_date': query.end_date,
+                'min_days': query.min_days,
+                'max_days': query.max_days
+            },
+            report,
+            completed=_completed_sessions(query),
+            checkpoint=_checkpoint_session(query),
+            history=_price_history
+        )
+        _notify(
+            bot,
+            query.user_id,
+            f'I was restarted while looking for flights from {query.origin} to {query.destination}. '
+            'I am picking up where I left off...'
+        )
+        _submit_query(query.user_id, fq, functools.partial(_notify, bot, query.user_id))
+        logger.info('Resumed query of "%s" with %d sessions already completed.', query.username, len(fq.completed))
+
+
+def _submit_query(user_id, fq, send):
+    TASKS[user_id] = fq
+    position = DISPATCHER.submit(fq, lambda: send('It is your turn! I am looking for your flights now...'))
+    if position:
+        send(f'There {"is 1 search" if position == 1 else f"are {position} searches"} ahead of yours, '
+             'I will start with yours as soon as possible.')
+
+
 def _validate_date(update):
     try:
         date = update.message.text
@@ -113,46 +297,39 @@ def start(update, context):
     update.message.reply_text(
         'Hi! My name is SkyscannerBot. I will help you find a cheap flight. '
         'Send /cancel to stop talking to me.\n\n'
-        'What is the origin of your flight?'
+        'What is the origin of your flight? '
+        'If you could leave from several places, separate them with commas.'
     )
     return ORIGIN
 
 
 def origin(update, context):
-    origin_code = get_place(CONFIG['x-rapidapi-keys'][0], update.message.text)
-    if not origin_code:
-        update.message.reply_text(
-            'It seems like you made a mistake spelling it or there are no flights from a city named '
-            f'{update.message.text}. '
-            'Try again with a different origin...'
-        )
+    origin_codes = _lookup_places(update, CONFIG.get('max-places', MAX_PLACES))
+    if not origin_codes:
         return ORIGIN
-    context.chat_data['origin'] = origin_code
+    context.chat_data['origin'] = origin_codes
     context.chat_data['query'].origin = update.message.text
+    context.chat_data['query'].origin_id = ','.join(origin_codes)
     update.message.reply_text(
         f'I have heard {update.message.text} is a very nice place! '
-        'Where are you going to?'
+        'Where are you going to? You can also give me several places separated with commas.'
     )
     return DESTINATION
 
 
 def destination(update, context):
-    destination_code = get_place(CONFIG['x-rapidapi-keys'][0], update.message.text)
-    if not destination_code:
-        update.message.reply_text(
-            'It seems like you made a mistake spelling it or there are no flights from a city named '
-            f'{update.message.text}. '
-            'Try again with a different destination...'
-        )
+    destination_codes = _lookup_places(update, CONFIG.get('max-places', MAX_PLACES))
+    if not destination_codes:
         return DESTINATION
-    if destination_code == context.chat_data['origin']:
+    if not any(o != d for o in context.chat_data['origin'] for d in destination_codes):
         update.message.reply_text(
             f'Your origin and destination cannot be both {update.message.text}! '
             'Try again with a different destination...'
         )
         return DESTINATION
-    context.chat_data['destination'] = destination_code
+    context.chat_data['destination'] = destination_codes
     context.chat_data['query'].destination = update.message.text
+    context.chat_data['query'].destination_id = ','.join(destination_codes)
     reply_keyboard = [['Round trip', 'One way']]
     update.message.reply_text(
         f'I would like to go to {update.message.text} as well! '
@@ -249,19 +426,20 @@ def max_days(update, context):
 
 
 def finish_conversation(update, context):
-    context.chat_data['query'].save()
+    model.WRITER.save(context.chat_data['query'])
     update.message.reply_text(
         'Alright, I think I have everything I needed. '
         'I will be back as soon as I find the best flights for you...'
     )
     fq = FlightQuery(
-        CONFIG,
+        DISPATCHER,
         context.chat_data,
-        _send_result_message(update, context)
+        _send_result_message(update, context),
+        _send_progress_message(update) if CONFIG.get('stream-results', True) else None,
+        checkpoint=_checkpoint_session(context.chat_data['query']),
+        history=_price_history
     )
-    t = threading.Thread(target=fq.execute)
-    t.start()
-    TASKS[update.effective_user.id] = t
+    _submit_query(update.effective_user.id, fq, update.message.reply_text)
     logger.info('Completed query for "%s".', update.effective_user.full_name)
     return ConversationHandler.END
 
@@ -271,7 +449,7 @@ def error(update, context):
     logger.warning('Update "%s" caused error "%s"', update, context.error)
     _remove_previous_task(update)
     context.chat_data['query'].cancelled = True
-    context.chat_data['query'].save()
+    model.WRITER.save(context.chat_data['query'])
 
 
 def cancel(update, context):
@@ -281,7 +459,7 @@ def cancel(update, context):
     logger.info("User %s canceled the conversation.", user.first_name)
     update.message.reply_text('Bye! I hope we can talk again some day.',
                               reply_markup=ReplyKeyboardRemove())
-    context.chat_data['query'].save()
+    model.WRITER.save(context.chat_data['query'])
     return ConversationHandler.END
 
 
@@ -316,6 +494,9 @@ def main():
     # log all errors
     dp.add_error_handler(error)
 
+    # Pick up the queries interrupted by the last shutdown
+    _resume_queries(updater.bot)
+
     # Start the Bot
     updater.start_polling()
 
@@ -323,10 +504,15 @@ def main():
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
+    model.WRITER.flush()
 
 
 if __name__ == '__main__':
     TASKS = {}
     with open('config.json') as config:
         CONFIG = json.load(config)
+        serve(CONFIG)
+        PLACES = PlaceIndex.from_config(CONFIG)
+        DISPATCHER = Dispatcher(CONFIG, observe=_record_quotes)
+        DISPATCHER.start()
         main()
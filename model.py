@@ -1,6 +1,38 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
+
+DB_FILE = 'db.sqlite3'
+DB_MAX_CONNECTIONS = 16
+DB_STALE_TIMEOUT = 5 * 60
+DB_BUSY_TIMEOUT = 10
+DB_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',  # durable enough with WAL, commits no longer wait for an fsync
+    'cache_size': -16 * 1024,
+    'temp_store': 'memory'
+}
+QUOTE_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 200
+WRITE_INTERVAL = 0.5
+WRITE_RETRIES = 3
 
-db = SqliteDatabase('db.sqlite3')
+logger = logging.getLogger(__name__)
+
+db = PooledSqliteDatabase(
+    DB_FILE,
+    max_connections=DB_MAX_CONNECTIONS,
+    stale_timeout=DB_STALE_TIMEOUT,
+    timeout=DB_BUSY_TIMEOUT,
+    pragmas=DB_PRAGMAS,
+    check_same_thread=False
+)
 
 
 class Query(Model):
@@ -10,6 +42,8 @@ class Query(Model):
     results_date = DateTimeField(null=True)
     origin = CharField(null=True)
     destination = CharField(null=True)
+    origin_id = CharField(null=True)
+    destination_id = CharField(null=True)
     start_date = DateField(null=True)
     round_trip = BooleanField(default=False)
     end_date = DateField(null=True)
@@ -19,9 +53,157 @@ class Query(Model):
 
     class Meta:
         database = db
+        indexes = (
+            (('user_id', 'creation_date'), False),
+            (('creation_date',), False)
+        )
+
+    @classmethod
+    def unfinished(cls):
+        # Queries that were being executed when the bot stopped
+        return cls.select().where(
+            cls.results_date.is_null(),
+            ~cls.cancelled,
+            cls.origin_id.is_null(False),
+            cls.end_date.is_null(False)
+        )
+
+
+class Session(Model):
+    query = ForeignKeyField(Query, backref='sessions', on_delete='CASCADE')
+    origin = CharField(null=True)  # route of the session, queries over several airports have more than one
+    destination = CharField(null=True)
+    start_date = CharField()
+    end_date = CharField(null=True)
+    direct = TextField(null=True)
+    with_stops = TextField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('query', 'start_date', 'end_date'), False),
+        )
+
+
+class Quote(Model):
+    origin = CharField()
+    destination = CharField()
+    start_date = DateField()
+    end_date = DateField(null=True)
+    direct = BooleanField()
+    price = FloatField()
+    carriers = CharField()
+    observed_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        database = db
+        indexes = (
+            # Covers the per-day price lookups of a route without touching the table
+            (('origin', 'destination', 'start_date', 'observed_at', 'end_date', 'price'), False),
+        )
+
+    @classmethod
+    def record(cls, rows):
+        with db.atomic():
+            for batch in chunked(rows, QUOTE_BATCH_SIZE):
+                cls.insert_many(batch).execute()
+
+    @classmethod
+    def cheapest_by_day(cls, origin, destination, since):
+        return (cls
+                .select(cls.start_date, fn.MIN(cls.price).alias('price'))
+                .where(cls.origin == origin, cls.destination == destination, cls.observed_at >= since)
+                .group_by(cls.start_date)
+                .order_by(cls.start_date))
+
+    @classmethod
+    def cheapest_known(cls, origin, destination, since):
+        query = (cls
+                 .select(cls.start_date, cls.end_date, fn.MIN(cls.price).alias('price'))
+                 .where(cls.origin == origin, cls.destination == destination, cls.observed_at >= since)
+                 .group_by(cls.start_date, cls.end_date))
+        with db.connection_context():
+            return {
+                (str(q.start_date), str(q.end_date) if q.end_date else None): q.price
+                for q in query
+            }
+
+
+class WriteBehind:
+    # Serializes every write on one thread and commits them in batches, so callers never wait for the disk
+    def __init__(self, database, batch_size=WRITE_BATCH_SIZE, interval=WRITE_INTERVAL):
+        self.database = database
+        self.batch_size = batch_size
+        self.interval = interval
+        self._tasks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def save(self, instance):
+        self._tasks.put(instance.save)
+
+    def submit(self, fn, *args, **kwargs):
+        self._tasks.put(lambda: fn(*args, **kwargs))
+
+    def flush(self):
+        done = threading.Event()
+        self._tasks.put(done)
+        done.wait()
+
+    def _next_batch(self):
+        batch = [self._tasks.get()]
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._tasks.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        # Saving an instance once writes its latest state, repeated saves in a batch are redundant
+        return list(dict.fromkeys(batch))
+
+    def _write(self, tasks):
+        with self.database.connection_context(), self.database.atomic():
+            for task in tasks:
+                try:
+                    task()
+                except Exception:
+                    logger.exception('Could not write to the database')
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            tasks = [task for task in batch if not isinstance(task, threading.Event)]
+            # peewee keeps the id given to an insert that was rolled back, saving it again would update no row
+            inserts = [task.__self__ for task in tasks
+                       if isinstance(getattr(task, '__self__', None), Model) and task.__self__._pk is None]
+            # A failed commit or connection must not stop the thread, flush() would wait on it forever
+            for attempt in range(1, WRITE_RETRIES + 1):
+                try:
+                    self._write(tasks)
+                    break
+                except Exception:
+                    logger.exception(f'Could not commit {len(tasks)} writes (attempt {attempt}/{WRITE_RETRIES})')
+                    for instance in inserts:
+                        instance._pk = None
+                    time.sleep(self.interval * attempt)
+            else:
+                logger.error(f'Dropped {len(tasks)} writes')
+            for done in batch:
+                if isinstance(done, threading.Event):
+                    done.set()
 
 
 db.connect()
-if not db.table_exists('Query'):
-    db.create_tables([Query])
+db.create_tables([Query, Session, Quote], safe=True)
+migrator = SqliteMigrator(db)
+for table, fields in (('query', (Query.origin_id, Query.destination_id)),
+                      ('session', (Session.origin, Session.destination))):
+    columns = {column.name for column in db.get_columns(table)}
+    migrate(*(
+        migrator.add_column(table, field.column_name, field)
+        for field in fields
+        if field.column_name not in columns
+    ))
 db.close()
+
+WRITER = WriteBehind(db)
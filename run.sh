@@ -6,17 +6,9 @@ mkdir -p logs
 # Init database monitoring tool
 venv/bin/sqlite_web -H 0.0.0.0 -p 7070 db.sqlite3 &
 
-# Start session makers
-for i in {0..3}
-do
-  venv/bin/python -m api.maker config.json 2> "logs/log_maker$i.txt" &
-done
-
-# Start session pollers
-for i in {0..9}
-do
-  venv/bin/python -m api.poller config.json 2> "logs/log_poller$i.txt" &
-done
+# Start the supervisor of the session makers and pollers, it sizes both pools after their queues
+# (set "async-workers" in config.json to run `api.aio` workers multiplexing many sessions each)
+venv/bin/python -m api.supervisor config.json 2> logs/log_supervisor.txt &
 
 # Start bot
 venv/bin/python bot.py 2> logs/log.txt &